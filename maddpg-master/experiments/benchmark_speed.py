@@ -0,0 +1,206 @@
+import argparse
+import numpy as np
+import time
+import sys
+sys.path.append('../')
+from multiagent.core import World, Agent, Landmark
+from multiagent.spatial import knn_indices, NeighborIndex
+from multiagent.reference import reference_spread_reward, reference_spread_observation
+import multiagent.scenarios as scenarios
+from maddpg.common.segment_tree import SumSegmentTree
+from maddpg.trainer.replay_buffer import ReplayBuffer, ArrayReplayBuffer, PrioritizedReplayBuffer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser("Speed benchmarks for the multiagent environments")
+    parser.add_argument("case", type=str, choices=sorted(CASES.keys()), help="benchmark to run")
+    parser.add_argument("--sizes", type=str, default="50,100,200,500,1000", help="comma separated entity counts")
+    parser.add_argument("--repeats", type=int, default=10, help="number of timed calls per size")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_args()
+
+
+def timeit(fn, repeats):
+    fn()
+    t_start = time.time()
+    for _ in range(repeats):
+        fn()
+    return (time.time() - t_start) / repeats * 1e3
+
+
+def make_swarm_world(num_agents, num_landmarks, density=25.0):
+    # entities scattered over an arena that grows with the swarm (constant density)
+    world = World()
+    world.array_mode = True
+    half_width = np.sqrt((num_agents + num_landmarks) / density) / 2
+    world.agents = [Agent() for i in range(num_agents)]
+    for agent in world.agents:
+        agent.silent = True
+        agent.size = 0.05
+        agent.max_speed = 1.0
+        agent.state.p_pos = np.random.uniform(-half_width, +half_width, world.dim_p)
+        agent.state.p_vel = np.zeros(world.dim_p)
+        agent.action.u = np.random.randn(world.dim_p)
+    world.landmarks = [Landmark() for i in range(num_landmarks)]
+    for landmark in world.landmarks:
+        landmark.size = 0.1
+        landmark.state.p_pos = np.random.uniform(-half_width, +half_width, world.dim_p)
+        landmark.state.p_vel = np.zeros(world.dim_p)
+    world.build_arrays()
+    return world
+
+
+def bench_collisions(arglist):
+    # brute force vs spatial hash broad phase for the contact forces
+    print("{:>8} {:>12} {:>12} {:>12}".format("entities", "brute (ms)", "grid (ms)", "max |df|"))
+    for n in [int(x) for x in arglist.sizes.split(",")]:
+        world = make_swarm_world(n - n // 5, n // 5)
+        p_force = world.apply_action_force_arrays()
+        results = {}
+        for broadphase in ['brute', 'grid']:
+            world.collision_broadphase = broadphase
+            results[broadphase] = world.apply_environment_force_arrays(p_force.copy())
+            results[broadphase + '_ms'] = timeit(lambda: world.apply_environment_force_arrays(p_force.copy()),
+                                                 arglist.repeats)
+        print("{:>8} {:>12.3f} {:>12.3f} {:>12.2e}".format(
+            n, results['brute_ms'], results['grid_ms'], np.max(np.abs(results['brute'] - results['grid']))))
+
+
+def bench_adjacency(arglist, neighbors=4, radius=0.8, skin=0.3, steps=50):
+    # brute force k-nearest-neighbour search vs Verlet neighbour lists on a random walk
+    print("{:>8} {:>12} {:>12} {:>10} {:>8}".format("agents", "brute (ms)", "verlet (ms)", "rebuilds", "equal"))
+    for n in [int(x) for x in arglist.sizes.split(",")]:
+        half_width = np.sqrt(n / 4.0) / 2
+        points = np.random.uniform(-half_width, +half_width, (n, 2))
+        walk = [points]
+        for _ in range(steps):
+            # at most max_speed * dt = 0.1 per step
+            step = np.random.uniform(-1, 1, (n, 2))
+            walk.append(walk[-1] + 0.07 * step)
+        index = NeighborIndex(radius, skin)
+        equal = True
+        t_brute, t_verlet = 0.0, 0.0
+        for points in walk:
+            t_start = time.time()
+            brute = knn_indices(points, neighbors, radius)
+            t_brute += time.time() - t_start
+            t_start = time.time()
+            verlet = index.knn(points, neighbors)
+            t_verlet += time.time() - t_start
+            equal = equal and np.array_equal(brute, verlet)
+        print("{:>8} {:>12.3f} {:>12.3f} {:>10} {:>8}".format(
+            n, t_brute / len(walk) * 1e3, t_verlet / len(walk) * 1e3, index.rebuilds, str(equal)))
+
+
+def bench_spread(arglist):
+    # simple_spread reward and observation of all agents: per-agent loops vs reward_all / observation_all
+    scenario = scenarios.make("simple_spread")
+    print("{:>8} {:>14} {:>14} {:>12}".format("agents", "per-agent (ms)", "batched (ms)", "max |diff|"))
+    for n in [int(x) for x in arglist.sizes.split(",")]:
+        world = make_swarm_world(n, n)
+        world.observing_range = 0.7
+
+        def per_agent():
+            return ([reference_spread_reward(scenario, agent, world) for agent in world.agents],
+                    [reference_spread_observation(agent, world) for agent in world.agents])
+
+        def batched():
+            # the state does not change between repeats: drop the geometry so that every
+            # call pays for the distance matrices, as the first call after a step does
+            world.invalidate_geometry()
+            return scenario.reward_all(world), scenario.observation_all(world)
+        # the loops are cubic in the swarm size, they are timed once
+        t_start = time.time()
+        reward, obs = per_agent()
+        per_agent_ms = (time.time() - t_start) * 1e3
+        reward_all, obs_all = batched()
+        diff = max(np.max(np.abs(np.array(reward) - reward_all)), np.max(np.abs(np.array(obs) - obs_all)))
+        print("{:>8} {:>14.3f} {:>14.3f} {:>12.2e}".format(n, per_agent_ms, timeit(batched, arglist.repeats), diff))
+
+
+def bench_replay(arglist, batch_size=1024):
+    # prioritized replay on a full buffer: sampling a batch, its importance weights and
+    # the priority update, vs uniform sampling; sizes are buffer capacities here
+    print("{:>10} {:>12} {:>16} {:>12} {:>12} {:>8}".format(
+        "capacity", "uniform (ms)", "prioritized (ms)", "weights (ms)", "update (ms)", "equal"))
+    for size in [int(x) for x in arglist.sizes.split(",")]:
+        buffer = PrioritizedReplayBuffer(size, seed=arglist.seed)
+        # fill the priorities directly, the stored transitions do not matter here
+        buffer._size = size
+        priorities = np.random.exponential(size=size)
+        buffer.update_priorities(np.arange(size), priorities)
+        index = buffer.make_index(batch_size)
+        td_error = np.random.exponential(size=batch_size)
+        # the tree descent must match a search over the cumulative priorities
+        tree = SumSegmentTree(buffer._it_capacity)
+        tree[np.arange(size)] = priorities
+        mass = np.random.uniform(0, tree.sum(), batch_size)
+        equal = np.array_equal(tree.find_prefixsum_idx(mass),
+                               np.minimum(np.searchsorted(np.cumsum(priorities), mass, side='right'), size - 1))
+        print("{:>10} {:>12.3f} {:>16.3f} {:>12.3f} {:>12.3f} {:>8}".format(
+            size, timeit(lambda: ReplayBuffer.make_index(buffer, batch_size), arglist.repeats),
+            timeit(lambda: buffer.make_index(batch_size), arglist.repeats),
+            timeit(lambda: buffer.importance_weights(index, 0.4), arglist.repeats),
+            timeit(lambda: buffer.update_priorities(index, td_error), arglist.repeats), str(equal)))
+
+
+# bytes per transition of the arrays held by a tuple ReplayBuffer, each array counted once
+# (train.py stores the same observation list as obs_tp1 of one step and obs_t of the next)
+def tuple_replay_bytes(buffer):
+    arrays = {}
+    for data in buffer._storage:
+        for field in data:
+            for value in field:
+                if isinstance(value, np.ndarray):
+                    arrays[id(value)] = value.nbytes
+                else:
+                    arrays[id(value)] = np.asarray(value).nbytes
+    return sum(arrays.values()) // len(buffer)
+
+
+def bench_replay_dtypes(arglist, steps=256, batch_size=256):
+    # replay storage dtype policies (and compact adjacency) against the tuple ReplayBuffer on
+    # large simple_spread transitions: memory per transition, sampling time, and the largest
+    # difference of the sampled update inputs from the tuple layout once both are cast to
+    # float32, as they are when fed to the graph (tests/test_replay_buffer.py asserts the
+    # bounds). The dense float64 layouts take n_agents ** 2 * 64 bytes per transition
+    print("{:>8} {:>8} {:>8} {:>16} {:>12} {:>12}".format(
+        "agents", "policy", "compact", "bytes/transition", "sample (ms)", "max |err|"))
+    for n in [int(x) for x in arglist.sizes.split(",")]:
+        env = scenarios.make_env("simple_spread", "large", num_agents=n, num_landmarks=n)
+        reference = ReplayBuffer(steps, seed=arglist.seed)
+        buffers = [((policy, compact), ArrayReplayBuffer(steps, seed=arglist.seed, compact_adj=compact,
+                                                         dtype_policy=policy))
+                   for policy, compact in [('float32', False), ('float32', True), ('float16', True)]]
+        obs_n, adj_n = env.reset()
+        for _ in range(steps):
+            action_n = [np.random.dirichlet(np.ones(space.n)) for space in env.action_space]
+            new_obs_n, rew_n, done_n, info_n, new_adj_n = env.step(action_n)
+            for buffer in [reference] + [buffer for _, buffer in buffers]:
+                buffer.add(obs_n, action_n, rew_n, new_obs_n, [float(x) for x in done_n], adj_n, new_adj_n)
+            obs_n, adj_n = new_obs_n, new_adj_n
+        index = reference.make_index(batch_size)
+        expected = reference.sample_index(index)
+        print("{:>8} {:>8} {:>8} {:>16} {:>12.3f} {:>12}".format(
+            n, "tuple", "-", tuple_replay_bytes(reference),
+            timeit(lambda: reference.sample_index(index), arglist.repeats), "-"))
+        for (policy, compact), buffer in buffers:
+            batch = buffer.sample_index(index)
+            err = max(np.max(np.abs(x.astype(np.float32) - y.astype(np.float32))) for x, y in zip(batch, expected))
+            print("{:>8} {:>8} {:>8} {:>16} {:>12.3f} {:>12.2e}".format(
+                n, policy, str(compact), sum(array[0].nbytes for array in buffer._arrays),
+                timeit(lambda: buffer.sample_index(index), arglist.repeats), err))
+
+
+CASES = {
+    'adjacency': bench_adjacency,
+    'collisions': bench_collisions,
+    'replay': bench_replay,
+    'replay_dtypes': bench_replay_dtypes,
+    'spread': bench_spread,
+}
+
+if __name__ == '__main__':
+    arglist = parse_args()
+    np.random.seed(arglist.seed)
+    CASES[arglist.case](arglist)
@@ -1,4 +1,5 @@
 import argparse
+import functools
 import numpy as np
 import tensorflow as tf
 import time
@@ -7,6 +8,7 @@ import sys
 sys.path.append('../')
 import maddpg.common.tf_util as U
 from maddpg.trainer.maddpg import MADDPGAgentTrainer
+from maddpg.trainer.replay_buffer import JointReplayBuffer
 import tensorflow.contrib.layers as layers
 
 exist_no_adversaries = False
@@ -18,7 +20,16 @@ def parse_args():
     parser.add_argument("--scenario", type=str, default="simple_spread", help="name of the scenario script")
     parser.add_argument("--max-episode-len", type=int, default=30, help="maximum episode length")
     parser.add_argument("--num-episodes", type=int, default=60000, help="number of episodes")
-    parser.add_argument("--num-adversaries", type=int, default=5, help="number of adversaries")
+    parser.add_argument("--num-adversaries", type=int, default=None, help="number of adversaries (default: as in the scenario)")
+    # Scenario size (default: as in the scenario script)
+    parser.add_argument("--preset", type=str, default=None, help="size preset of the scenario, e.g. large")
+    parser.add_argument("--num-agents", type=int, default=None, help="number of agents")
+    parser.add_argument("--num-good-agents", type=int, default=None, help="number of good agents (predator-prey scenarios)")
+    parser.add_argument("--num-landmarks", type=int, default=None, help="number of landmarks")
+    parser.add_argument("--neighbors", type=int, default=None, help="number of neighbours in the adjacency")
+    parser.add_argument("--observing-range", type=float, default=None, help="observation range of the agents")
+    parser.add_argument("--num-envs", type=int, default=1, help="number of environment copies stepped together on batched arrays")
+    parser.add_argument("--env-workers", type=int, default=0, help="number of worker processes stepping one environment copy each")
     parser.add_argument("--good-policy", type=str, default="maddpg", help="policy for good agents")
     parser.add_argument("--adv-policy", type=str, default="maddpg", help="policy of adversaries")
     # Core training parameters
@@ -26,6 +37,14 @@ def parse_args():
     parser.add_argument("--gamma", type=float, default=0.95, help="discount factor")
     parser.add_argument("--batch-size", type=int, default=1024, help="number of episodes to optimize at the same time")
     parser.add_argument("--num-units", type=int, default=64, help="number of units in the mlp")
+    parser.add_argument("--replay-dir", type=str, default=None, help="directory of memory-mapped replay buffers (default: in memory)")
+    parser.add_argument("--replay-dtype", type=str, default="float32", choices=["float64", "float32", "float16"], help="storage dtypes of the replay buffer")
+    parser.add_argument("--frame-replay", action="store_true", default=False, help="store every observation once in the replay buffer")
+    parser.add_argument("--shared-replay-batch", action="store_true", default=False, help="train all trainers on one minibatch per update step")
+    parser.add_argument("--prioritized-replay", action="store_true", default=False, help="use prioritized experience replay")
+    parser.add_argument("--prioritized-replay-alpha", type=float, default=0.6, help="how much prioritization is used")
+    parser.add_argument("--prioritized-replay-beta", type=float, default=0.4, help="strength of the importance sampling correction")
+    parser.add_argument("--prioritized-replay-eps", type=float, default=1e-6, help="added to the TD errors to get the priorities")
     # Checkpointing
     parser.add_argument("--exp-name", type=str, default=None, help="name of the experiment")
     parser.add_argument("--save-dir", type=str, default="./ckpt_simple_spread_5/test-model.ckpt", help="directory in which training state and model should be saved")
@@ -38,7 +57,17 @@ def parse_args():
     parser.add_argument("--benchmark-iters", type=int, default=100000, help="number of iterations run for benchmarking")
     parser.add_argument("--benchmark-dir", type=str, default="./benchmark_files/", help="directory where benchmark data is saved")
     parser.add_argument("--plots-dir", type=str, default="./learning_curves/", help="directory where plot data is saved")
-    return parser.parse_args()
+    arglist = parser.parse_args()
+    if arglist.env_workers > 0:
+        if arglist.num_envs not in (1, arglist.env_workers):
+            parser.error("--env-workers runs one environment copy per worker, --num-envs must match it")
+        arglist.num_envs = arglist.env_workers
+    # the copies are reset independently and their transitions interleave in the replay
+    # buffer, evaluation runs on a single environment
+    if (arglist.num_envs > 1 or arglist.env_workers > 0) and \
+            (arglist.frame_replay or arglist.display or arglist.benchmark):
+        parser.error("--num-envs > 1 and --env-workers cannot be combined with --frame-replay, --display or --benchmark")
+    return arglist
 
 
 def mlp_model(input, num_outputs, scope, reuse=False, num_units=64, rnn_cell=None):
@@ -122,42 +151,74 @@ def my_graph_model_policy_network(input1, input2, vec, neighbors, agent_n, num_o
 
 
 def make_env(scenario_name, arglist, benchmark=False):
-    from multiagent.environment import MultiAgentEnv
     import multiagent.scenarios as scenarios
 
-    # load scenario from script
-    scenario = scenarios.load(scenario_name + ".py").Scenario()
-    # create world
-    world = scenario.make_world()
-    # create multiagent environment
-    if benchmark:
-        env = MultiAgentEnv(world, scenario.reset_world, scenario.reward, scenario.observation, scenario.benchmark_data)
-    else:
-        env = MultiAgentEnv(world, scenario.reset_world, scenario.reward, scenario.observation)
-    return env
+    # load scenario from script, with the size parameters given on the command line
+    params = dict((key, getattr(arglist, key)) for key in
+                  ['num_agents', 'num_good_agents', 'num_landmarks', 'neighbors', 'observing_range']
+                  if getattr(arglist, key, None) is not None)
+    # create multiagent environment, a BatchMultiAgentEnv of worker processes with --env-workers
+    # and a VectorMultiAgentEnv over several copies with --num-envs
+    num_envs = getattr(arglist, 'num_envs', 1)
+    if getattr(arglist, 'env_workers', 0) > 0:
+        from multiagent.environment import BatchMultiAgentEnv
+        env_fn = functools.partial(scenarios.make_env, scenario_name, getattr(arglist, 'preset', None), benchmark,
+                                   **params)
+        return BatchMultiAgentEnv([env_fn] * arglist.env_workers, arglist.max_episode_len)
+    if num_envs > 1:
+        return scenarios.make_vector_env(scenario_name, num_envs, getattr(arglist, 'preset', None),
+                                         arglist.max_episode_len, benchmark, **params)
+    return scenarios.make_env(scenario_name, getattr(arglist, 'preset', None), benchmark, **params)
 
 
 def get_trainers(env, num_adversaries, obs_shape_n, arglist):
     trainers = []
     model = mlp_model
     trainer = MADDPGAgentTrainer
+    # the adjacency placeholders take the neighbour counts of the world, e.g. 4 in the large presets
+    neighbors = dict(neighbor_n_pred=env.world.neighbors_pred, neighbor_n_prey=env.world.neighbors_prey)
     trainers.append(trainer(
         "adversaries", my_graph_model_policy_network, model, obs_shape_n, env.action_space, num_adversaries,
-        arglist, local_q_func=(arglist.adv_policy == 'ddpg')))
+        arglist, local_q_func=(arglist.adv_policy == 'ddpg'), **neighbors))
     if exist_no_adversaries:
         trainers.append(trainer(
             "no_adversaries", my_graph_model_policy_network, model, obs_shape_n, env.action_space, num_adversaries,
-            arglist, local_q_func=(arglist.good_policy == 'ddpg')))
+            arglist, local_q_func=(arglist.good_policy == 'ddpg'), **neighbors))
     return trainers
 
 
+# actions of the agents of a trainer from their observations and adjacency: (act_dim,)
+# arrays for a single environment, (num_envs, act_dim) arrays for stacked copies
+def get_actions(trainer, obs, adj, num_envs=None):
+    if num_envs is None:
+        return [act.reshape((-1)) for act in trainer.action(obs + adj + [trainer.neighbor_vec(1)[0]])]
+    return trainer.batch_action(obs + adj + [trainer.neighbor_vec(num_envs)])
+
+
+# store one transition of all agents, the first num_adversaries with the first trainer
+# and the others with the second one if there is one
+def collect_experience(trainers, num_adversaries, obs_n, action_n, rew_n, new_obs_n, done_n, adj_n, new_adj_n,
+                       terminal):
+    n = len(obs_n)
+    trainers[0].experience(obs_n[0:num_adversaries], action_n[0:num_adversaries],
+                           rew_n[0:num_adversaries], new_obs_n[0:num_adversaries],
+                           done_n[0:num_adversaries], adj_n[0:num_adversaries],
+                           new_adj_n[0:num_adversaries], terminal)
+    if exist_no_adversaries:
+        trainers[1].experience(obs_n[num_adversaries:n], action_n[num_adversaries:n],
+                               rew_n[num_adversaries:n], new_obs_n[num_adversaries:n],
+                               done_n[num_adversaries:n], adj_n[num_adversaries:n],
+                               new_adj_n[num_adversaries:n], terminal)
+
+
 def train(arglist):
     with U.single_threaded_session():
         # Create environment
         env = make_env(arglist.scenario, arglist, arglist.benchmark)
         # Create agent trainers
         obs_shape_n = [env.observation_space[i].shape for i in range(env.n)]
-        num_adversaries = min(env.n, arglist.num_adversaries)
+        num_adversaries = env.world.num_adversaries if arglist.num_adversaries is None else arglist.num_adversaries
+        num_adversaries = min(env.n, num_adversaries)
         trainers = get_trainers(env, num_adversaries, obs_shape_n, arglist)
         print('Using good policy {} and adv policy {}'.format(arglist.good_policy, arglist.adv_policy))
 
@@ -177,61 +238,87 @@ def train(arglist):
         final_ep_ag_rewards = []  # agent rewards for training curve
         agent_info = [[[]]]  # placeholder for benchmarking info
         saver = tf.train.Saver()
+        # the replay buffers of all trainers are written in lockstep, with --shared-replay-batch
+        # the trainers share one batch per update step
+        joint_buffer = JointReplayBuffer([agent.replay_buffer for agent in trainers])
         obs_n, adj_n = env.reset()
         episode_step = 0
         train_step = 0
+        # with --num-envs or --env-workers the copies are stepped together: observations, actions
+        # and rewards have a leading (num_envs,) dimension and the environment resets finished copies
+        num_envs = arglist.num_envs if arglist.num_envs > 1 or arglist.env_workers > 0 else None
+        copy_rewards = np.zeros((arglist.num_envs, env.n))
+        num_saves = len(episode_rewards) // arglist.save_rate
         t_start = time.time()
 
         print('Starting iterations...')
         while True:
             # get action
-            vec = np.array([[1, 0]])
-            action_n1 = trainers[0].action(obs_n[0:num_adversaries] + adj_n[0:num_adversaries] + [vec])
+            action_n = get_actions(trainers[0], obs_n[0:num_adversaries], adj_n[0:num_adversaries], num_envs)
             if exist_no_adversaries:
-                vec = np.array([[1, 0]])
-                action_n2 = trainers[1].action(obs_n[num_adversaries:env.n] + adj_n[num_adversaries:env.n] + [vec])
-                action_n1.extend(action_n2)
-            action_n = []
-            for i, act in enumerate(action_n1):
-                act = act.reshape((-1))
-                action_n.append(act)
+                action_n.extend(get_actions(trainers[1], obs_n[num_adversaries:env.n], adj_n[num_adversaries:env.n],
+                                            num_envs))
 
             # environment step
             new_obs_n, rew_n, done_n, info_n, new_adj_n = env.step(action_n)
-            episode_step += 1
-            done = all(done_n)
-            terminal = (episode_step >= arglist.max_episode_len)
-
-            # collect experience
 
-            trainers[0].experience(obs_n[0:num_adversaries], action_n[0:num_adversaries],
-                                   rew_n[0:num_adversaries], new_obs_n[0:num_adversaries],
-                                   done_n[0:num_adversaries], adj_n[0:num_adversaries],
-                                   new_adj_n[0:num_adversaries], terminal)
-            if exist_no_adversaries:
-                trainers[1].experience(obs_n[num_adversaries:env.n], action_n[num_adversaries:env.n],
-                                       rew_n[num_adversaries:env.n], new_obs_n[num_adversaries:env.n],
-                                       done_n[num_adversaries:env.n], adj_n[num_adversaries:env.n],
-                                       new_adj_n[num_adversaries:env.n], terminal)
-
-            # update observation
-            obs_n = new_obs_n
-            adj_n = new_adj_n
-
-            for i, rew in enumerate(rew_n):
-                episode_rewards[-1] += rew
-                agent_rewards[i][-1] += rew
-
-            if done or terminal:
-                obs_n, adj_n = env.reset()
-                episode_step = 0
-                episode_rewards.append(0)
-                for a in agent_rewards:
-                    a.append(0)
-                agent_info.append([[]])
-
-            # increment global step counter
-            train_step += 1
+            if num_envs is None:
+                episode_step += 1
+                done = all(done_n)
+                terminal = (episode_step >= arglist.max_episode_len)
+
+                # collect experience
+                collect_experience(trainers, num_adversaries, obs_n, action_n, rew_n, new_obs_n, done_n,
+                                   adj_n, new_adj_n, done or terminal)
+
+                # update observation
+                obs_n = new_obs_n
+                adj_n = new_adj_n
+
+                for i, rew in enumerate(rew_n):
+                    episode_rewards[-1] += rew
+                    agent_rewards[i][-1] += rew
+
+                if done or terminal:
+                    obs_n, adj_n = env.reset()
+                    episode_step = 0
+                    episode_rewards.append(0)
+                    for a in agent_rewards:
+                        a.append(0)
+                    agent_info.append([[]])
+            else:
+                # the transitions of the copies that were reset end in the observations kept in info_n
+                ended = info_n['terminal']
+                last_obs_n, last_adj_n = new_obs_n, new_adj_n
+                if np.any(ended):
+                    last_obs_n = [np.where(ended[:, None], last, new)
+                                  for last, new in zip(info_n['terminal_obs_n'], new_obs_n)]
+                    last_adj_n = [np.where(ended[:, None, None], last, new)
+                                  for last, new in zip(info_n['terminal_adj_n'], new_adj_n)]
+
+                # collect experience, one transition per copy
+                for k in range(num_envs):
+                    collect_experience(trainers, num_adversaries, [obs[k] for obs in obs_n],
+                                       [act[k] for act in action_n], rew_n[k], [obs[k] for obs in last_obs_n],
+                                       done_n[k], [adj[k] for adj in adj_n], [adj[k] for adj in last_adj_n],
+                                       ended[k])
+
+                # update observation
+                obs_n = new_obs_n
+                adj_n = new_adj_n
+
+                copy_rewards += rew_n
+                for k in np.flatnonzero(ended):
+                    episode_rewards[-1] = np.sum(copy_rewards[k])
+                    episode_rewards.append(0)
+                    for i, a in enumerate(agent_rewards):
+                        a[-1] = copy_rewards[k, i]
+                        a.append(0)
+                    agent_info.append([[]])
+                    copy_rewards[k] = 0
+
+            # increment global step counter, by one per environment copy
+            train_step += arglist.num_envs
 
             # for benchmarking learned policies
             if arglist.benchmark:
@@ -251,15 +338,17 @@ def train(arglist):
                 env.render()
                 continue
 
-            # update all trainers, if not in display or benchmark mode
+            # update all trainers, if not in display or benchmark mode, once per environment step
             loss = None
-            for agent in trainers:
-                agent.pre_update()
-            for agent in trainers:
-                loss = agent.update(trainers, train_step)
-
-            # save model, display training output
-            if terminal and (len(episode_rewards) % arglist.save_rate == 0):
+            for t in range(train_step - arglist.num_envs + 1, train_step + 1):
+                for agent in trainers:
+                    agent.pre_update()
+                for agent in trainers:
+                    loss = agent.update(trainers, t, joint_buffer)
+
+            # save model, display training output, every save_rate episodes
+            if len(episode_rewards) // arglist.save_rate > num_saves:
+                num_saves = len(episode_rewards) // arglist.save_rate
                 U.save_state(arglist.save_dir, saver=saver)
                 # print statement depends on whether or not there are adversaries
                 if num_adversaries == 0:
@@ -285,6 +374,7 @@ def train(arglist):
                     pickle.dump(final_ep_ag_rewards, fp)
                 print('...Finished total of {} episodes.'.format(len(episode_rewards)))
                 break
+        env.close()
 
 if __name__ == '__main__':
     arglist = parse_args()
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class SegmentTree(object):
+    def __init__(self, capacity, operation, neutral_element):
+        """Array-backed segment tree over capacity leaves.
+
+        The tree is stored as a flat array: node i has the children 2 * i and
+        2 * i + 1, the root is node 1 and leaf j is node capacity + j. Reads and
+        writes take arrays of leaf indices, so a batch of updates refreshes each
+        level of the tree with one vectorized operation.
+
+        Parameters
+        ----------
+        capacity: int
+            Number of leaves, a power of two.
+        operation: np.ufunc
+            Associative operation combining two children, e.g. np.add or np.minimum.
+        neutral_element: float
+            Value of the empty leaves, e.g. 0 for np.add and inf for np.minimum.
+        """
+        assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be a positive power of 2."
+        self._capacity = capacity
+        self._operation = operation
+        self._value = np.full(2 * capacity, neutral_element, dtype=np.float64)
+
+    def __setitem__(self, idx, val):
+        # leaves, then the parents of the updated nodes up to the root, one level at a time
+        idx = np.asarray(idx, dtype=np.int64).reshape(-1) + self._capacity
+        self._value[idx] = val
+        idx = np.unique(idx // 2)
+        while idx.size > 0 and idx[0] >= 1:
+            self._value[idx] = self._operation(self._value[2 * idx], self._value[2 * idx + 1])
+            # the parents of sorted nodes are sorted, duplicates are adjacent
+            idx = idx // 2
+            idx = idx[np.concatenate([[True], idx[1:] != idx[:-1]])]
+
+    def __getitem__(self, idx):
+        return self._value[self._capacity + np.asarray(idx, dtype=np.int64)]
+
+    def reduce(self):
+        """Result of the operation over all the leaves."""
+        return self._value[1]
+
+
+class SumSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super(SumSegmentTree, self).__init__(capacity, np.add, 0.0)
+
+    def sum(self):
+        """Sum of all the leaves."""
+        return self.reduce()
+
+    def find_prefixsum_idx(self, prefixsum):
+        """Find the leaves where the cumulative sums reach the given values.
+
+        For every value v, returns the highest index i such that
+        leaves[0] + ... + leaves[i - 1] <= v, by descending the tree for all the
+        values at once (O(log capacity) vectorized steps). With v uniform in
+        [0, sum()) the leaves are sampled in proportion to their values.
+
+        Parameters
+        ----------
+        prefixsum: np.array
+            values of the cumulative sums
+
+        Returns
+        -------
+        idx: np.array
+            leaf indices, with the shape of prefixsum
+        """
+        prefixsum = np.array(prefixsum, dtype=np.float64)
+        idx = np.ones(prefixsum.shape, dtype=np.int64)
+        for _ in range(self._capacity.bit_length() - 1):
+            left = 2 * idx
+            go_right = prefixsum >= self._value[left]
+            prefixsum -= np.where(go_right, self._value[left], 0.0)
+            idx = left + go_right
+        return idx - self._capacity
+
+
+class MinSegmentTree(SegmentTree):
+    def __init__(self, capacity):
+        super(MinSegmentTree, self).__init__(capacity, np.minimum, float('inf'))
+
+    def min(self):
+        """Minimum of all the leaves."""
+        return self.reduce()
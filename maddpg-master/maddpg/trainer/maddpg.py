@@ -1,11 +1,12 @@
+import os
 import numpy as np
 import random
 import maddpg.common.tf_util as U
 
 from maddpg.common.distributions import make_pdtype
 from maddpg import AgentTrainer
-from maddpg.trainer.replay_buffer import ReplayBuffer
-import numpy.matlib as matlib
+from maddpg.trainer.replay_buffer import ArrayReplayBuffer, FrameReplayBuffer, MemmapReplayBuffer, \
+    PrioritizedReplayBuffer
 import tensorflow as tf
 
 
@@ -122,6 +123,8 @@ def q_train(name, make_obs_ph_n, adj_n, act_space_n, num_adversaries, neighbor_n
         obs_ph_n = make_obs_ph_n
         act_ph_n = [act_pdtype_n[i].sample_placeholder([None], name="action"+str(i)) for i in range(len(act_space_n))]
         target_ph = [tf.placeholder(tf.float32, [None], name="target") for _ in range(agent_n_species)]
+        # importance sampling weights of the transitions (ones for uniform replay)
+        weight_ph = tf.placeholder(tf.float32, [None], name="weight")
 
         q = []
         q_square = []
@@ -132,7 +135,8 @@ def q_train(name, make_obs_ph_n, adj_n, act_space_n, num_adversaries, neighbor_n
         # q1 = tf.stack([q[i] for i in range(agent_n_species)], axis=1)
         # q_square = [tf.square(tf.reduce_mean(q[i] - target_ph[i], axis=1)) for i in range(agent_n_species)]
         q_func_vars = [U.scope_vars(U.absolute_scope_name("q_func_%d" % i)) for i in range(agent_n_species)]
-        q_loss = [tf.reduce_mean(tf.square(q[i] - target_ph[i])) for i in range(agent_n_species)]
+        td_error = [q[i] - target_ph[i] for i in range(agent_n_species)]
+        q_loss = [tf.reduce_mean(weight_ph * tf.square(td_error[i])) for i in range(agent_n_species)]
 
         # viscosity solution to Bellman differential equation in place of an initial condition
         # q_reg = tf.reduce_mean(tf.square(q1))
@@ -142,8 +146,9 @@ def q_train(name, make_obs_ph_n, adj_n, act_space_n, num_adversaries, neighbor_n
         optimize_expr = [U.minimize_and_clip(optimizer, loss[i], q_func_vars[i], grad_norm_clipping)
                          for i in range(agent_n_species)]
 
-        # Create callable functions
-        train = [U.function(inputs=obs_ph_n + act_ph_n + [target_ph[i]], outputs=loss[i], updates=[optimize_expr[i]])
+        # Create callable functions, training returns the loss and the TD errors
+        train = [U.function(inputs=obs_ph_n + act_ph_n + [target_ph[i], weight_ph], outputs=[loss[i], td_error[i]],
+                            updates=[optimize_expr[i]])
                  for i in range(agent_n_species)]
         q_values = U.function(obs_ph_n + act_ph_n, q)
 
@@ -162,12 +167,15 @@ def q_train(name, make_obs_ph_n, adj_n, act_space_n, num_adversaries, neighbor_n
 
 
 class MADDPGAgentTrainer(AgentTrainer):
-    def __init__(self, name, p_model, q_model, obs_shape_n, act_space_n, num_adversaries, args, local_q_func=False):
+    def __init__(self, name, p_model, q_model, obs_shape_n, act_space_n, num_adversaries, args, local_q_func=False,
+                 neighbor_n_pred=2, neighbor_n_prey=2):
         self.name = name
         self.n = len(obs_shape_n)
         self.args = args
-        self.neighbor_n_pred = 2
-        self.neighbor_n_prey = 2
+        # neighbours per row of the adjacency of the adversaries and of the good agents, as in the world
+        self.neighbor_n_pred = neighbor_n_pred
+        self.neighbor_n_prey = neighbor_n_prey
+        self.neighbor_n = neighbor_n_pred if name == "adversaries" else neighbor_n_prey
         self.num_adversaries = num_adversaries
         adj_n = []
         obs_ph_n = []
@@ -214,32 +222,68 @@ class MADDPGAgentTrainer(AgentTrainer):
             num_units=args.num_units,
         )
 
-        # Create experience buffer
-        self.replay_buffer = ReplayBuffer(1e6)
+        # Create experience buffer, on disk (and reopened on restart) if a replay directory is given
+        self.prioritized_replay = getattr(args, 'prioritized_replay', False)
+        self.frame_replay = getattr(args, 'frame_replay', False)
+        if self.frame_replay and (self.prioritized_replay or getattr(args, 'replay_dir', None)):
+            raise ValueError('frame replay is only available for the uniform in-memory buffer')
+        dtype_policy = getattr(args, 'replay_dtype', 'float32')
+        if self.frame_replay:
+            self.replay_buffer = FrameReplayBuffer(1e6, compact_adj=True, dtype_policy=dtype_policy)
+        elif self.prioritized_replay:
+            self.replay_buffer = PrioritizedReplayBuffer(1e6, alpha=args.prioritized_replay_alpha, compact_adj=True,
+                                                         dtype_policy=dtype_policy)
+        elif getattr(args, 'replay_dir', None):
+            self.replay_buffer = MemmapReplayBuffer(1e6, os.path.join(args.replay_dir, self.name), compact_adj=True,
+                                                    dtype_policy=dtype_policy)
+        else:
+            self.replay_buffer = ArrayReplayBuffer(1e6, compact_adj=True, dtype_policy=dtype_policy)
         self.max_replay_buffer_len = args.batch_size * args.max_episode_len
         self.replay_sample_index = None
 
+    # attention selector of the policy: one-hot on the first neighbour, shape (batch_size, 1, neighbor_n)
+    def neighbor_vec(self, batch_size):
+        vec = np.zeros((batch_size, 1, self.neighbor_n))
+        vec[:, :, 0] = 1
+        return vec
+
     def action(self, obs):
         for _ in range(len(obs)):
             obs[_] = obs[_][None]
         return self.act(*obs)
 
+    # inputs that already have a leading batch dimension, e.g. from BatchMultiAgentEnv
+    def batch_action(self, obs):
+        return self.act(*obs)
+
     def experience(self, obs, act, rew, new_obs, done, adj, new_adj, terminal):
         # Store transition in the replay buffer.
         done_int = [float(x) for x in done]
-        self.replay_buffer.add(obs, act, rew, new_obs, done_int, adj, new_adj)
+        if self.frame_replay:
+            # the next transition starts from new_obs unless the environment is reset
+            self.replay_buffer.add(obs, act, rew, new_obs, done_int, adj, new_adj, episode_end=terminal)
+        else:
+            self.replay_buffer.add(obs, act, rew, new_obs, done_int, adj, new_adj)
 
     def pre_update(self):
         self.replay_sample_index = None
 
-    def update(self, agents, t):
+    # joint_buffer: optional JointReplayBuffer over the buffers of all the agents. With
+    # args.shared_replay_batch its batch of step t is gathered once and every trainer
+    # trains on it (uniform replay only); otherwise every trainer draws its own batch
+    def update(self, agents, t, joint_buffer=None):
         if len(self.replay_buffer) < self.max_replay_buffer_len: # replay buffer is not large enough
             return
         if not t % 100 == 0:  # only update every 100 steps
             return
 
-        # collect replay sample from all agents
-        self.replay_sample_index = self.replay_buffer.make_index(self.args.batch_size)
+        # collect replay sample from all agents, each species gathered once for the index
+        shared = getattr(self.args, 'shared_replay_batch', False) and not self.prioritized_replay
+        if joint_buffer is not None and shared:
+            self.replay_sample_index, samples = joint_buffer.shared_sample(self.args.batch_size, t)
+        else:
+            self.replay_sample_index = self.replay_buffer.make_index(self.args.batch_size)
+            samples = [agent.replay_buffer.sample_index(self.replay_sample_index) for agent in agents]
         index = self.replay_sample_index
         obs_n = []
         obs_next_n = []
@@ -248,14 +292,14 @@ class MADDPGAgentTrainer(AgentTrainer):
         adj_next_n = []
         for i in range(len(agents)):
             obs_record, act_record, rew_record, obs_next_record, done_record, adj_record, adj_next_record = \
-                agents[i].replay_buffer.sample_index(index)
+                samples[i]
             obs_n.append(obs_record)
             obs_next_n.append(obs_next_record)
             act_n.append(act_record)
             adj_n.append(adj_record)
             adj_next_n.append(adj_next_record)
 
-        obs, act, rew, obs_next, done, adj, adj_next = self.replay_buffer.sample_index(index)
+        obs, act, rew, obs_next, done, adj, adj_next = samples[agents.index(self)]
 
         target_act_next_n = []
         target_q_next_input_obs = []
@@ -271,25 +315,13 @@ class MADDPGAgentTrainer(AgentTrainer):
             target_act_next_input_obs = []
             target_act_next_input_adj = []
             for j in range(obs_n[_].shape[1]):  # traverse every agent in each species
-                _obs = []
-                _act = []
-                _adj = []
-                _obs_next = []
-                _adj_next = []
-                for i in range(self.args.batch_size):  # traverse each instance
-                    _obs.append(obs_n[_][i][j])
-                    _act.append(act_n[_][i][j])
-                    _adj.append(adj_n[_][i][j])
-                    _obs_next.append(obs_next_n[_][i][j])
-                    _adj_next.append(adj_next_n[_][i][j])
-                q_input_obs.append(np.array(_obs))
-                q_input_act.append(np.array(_act))
-                p_input_adj.append(np.array(_adj))
-                target_act_next_input_obs.append(np.array(_obs_next))
-                target_act_next_input_adj.append(np.array(_adj_next))
-            vec = matlib.repmat([1, 0], self.args.batch_size, 1)
-            vec = np.expand_dims(vec, axis=1)
-            target_act_next_input = target_act_next_input_obs + target_act_next_input_adj + [vec]
+                q_input_obs.append(obs_n[_][:, j])
+                q_input_act.append(act_n[_][:, j])
+                p_input_adj.append(adj_n[_][:, j])
+                target_act_next_input_obs.append(obs_next_n[_][:, j])
+                target_act_next_input_adj.append(adj_next_n[_][:, j])
+            target_act_next_input = (target_act_next_input_obs + target_act_next_input_adj
+                                     + [agent.neighbor_vec(self.args.batch_size)])
             temp = agent.target_act(*target_act_next_input)
             target_act_next_n.append(temp)
             target_q_next_input_obs.extend(target_act_next_input_obs)
@@ -307,12 +339,26 @@ class MADDPGAgentTrainer(AgentTrainer):
         target_q += rew + self.args.gamma * target_q_next
         target_q_list = [target_q.transpose()[i] for i in range(np.shape(target_q)[1])]
 
+        # importance sampling weights of the prioritized replay
+        if self.prioritized_replay:
+            weights = self.replay_buffer.importance_weights(index, self.args.prioritized_replay_beta)
+        else:
+            weights = np.ones(len(index))
+
         # train the critic network
         # q_train_input = q_input_obs_n + q_input_act_n + [target_q]
-        q_loss = [self.q_train[i](*(q_input_obs_n + q_input_act_n + [target_q_list[i]])) for i in range(len(self.q_train))]
+        q_out = [self.q_train[i](*(q_input_obs_n + q_input_act_n + [target_q_list[i], weights]))
+                 for i in range(len(self.q_train))]
+        q_loss = [loss for loss, _ in q_out]
+
+        # new priorities: mean absolute TD error of the critics of the species
+        if self.prioritized_replay:
+            td_error = np.mean(np.abs([td for _, td in q_out]), axis=0)
+            self.replay_buffer.update_priorities(index, td_error + self.args.prioritized_replay_eps)
 
         # train the policy network
-        p_loss = self.p_train(*(q_input_obs_n + q_input_act_n + p_input_adj_n + [vec]))
+        p_loss = self.p_train(*(q_input_obs_n + q_input_act_n + p_input_adj_n
+                                + [self.neighbor_vec(self.args.batch_size)]))
 
         self.p_update()
         self.q_update()
@@ -1,8 +1,9 @@
+import os
 import numpy as np
-import random
+from maddpg.common.segment_tree import SumSegmentTree, MinSegmentTree
 
 class ReplayBuffer(object):
-    def __init__(self, size):
+    def __init__(self, size, seed=None):
         """Create Prioritized Replay buffer.
 
         Parameters
@@ -10,10 +11,13 @@ class ReplayBuffer(object):
         size: int
             Max number of transitions to store in the buffer. When the buffer
             overflows the old memories are dropped.
+        seed: int or None
+            Seed of the random generator used to sample indices.
         """
         self._storage = []
         self._maxsize = int(size)
         self._next_idx = 0
+        self.seed(seed)
 
     def __len__(self):
         return len(self._storage)
@@ -36,22 +40,51 @@ class ReplayBuffer(object):
         for i in idxes:
             data = self._storage[i]
             obs_t, action, reward, obs_tp1, done, adj, adj_tp1 = data
-            obses_t.append(np.array(obs_t, copy=False))
-            actions.append(np.array(action, copy=False))
+            obses_t.append(np.asarray(obs_t))
+            actions.append(np.asarray(action))
             rewards.append(reward)
-            obses_tp1.append(np.array(obs_tp1, copy=False))
+            obses_tp1.append(np.asarray(obs_tp1))
             dones.append(done)
-            adjs.append(np.array(adj, copy=False))
-            adjs_tp1.append(np.array(adj_tp1, copy=False))
+            adjs.append(np.asarray(adj))
+            adjs_tp1.append(np.asarray(adj_tp1))
         return np.array(obses_t), np.array(actions), np.array(rewards), np.array(obses_tp1), \
                np.array(dones), np.array(adjs), np.array(adjs_tp1)
 
-    def make_index(self, batch_size):
-        return [random.randint(0, len(self._storage) - 1) for _ in range(batch_size)]
+    def seed(self, seed=None):
+        """Reset the random generator used to sample indices (self.rng)."""
+        self.rng = np.random.default_rng(seed)
+
+    def make_index(self, batch_size, replace=True, chunk=None):
+        """Sample the indices of a batch of transitions.
+
+        Parameters
+        ----------
+        batch_size: int
+            How many indices to sample.
+        replace: bool
+            Whether the same transition can be drawn more than once. Without
+            replacement the buffer must hold at least batch_size transitions.
+        chunk: int or None
+            If given, the batch is made of runs of chunk consecutive transitions
+            (in ring order) from random starting points, so that the gathers read
+            contiguous memory. replace is ignored.
+
+        Returns
+        -------
+        idxes: np.array
+            (batch_size,) indices of the transitions
+        """
+        if chunk is not None:
+            starts = self.rng.integers(0, len(self), -(-batch_size // chunk))
+            idxes = (starts[:, None] + np.arange(chunk)) % len(self)
+            return idxes.reshape(-1)[:batch_size]
+        if replace:
+            return self.rng.integers(0, len(self), batch_size)
+        return self.rng.choice(len(self), batch_size, replace=False)
 
     def make_latest_index(self, batch_size):
-        idx = [(self._next_idx - 1 - i) % self._maxsize for i in range(batch_size)]
-        np.random.shuffle(idx)
+        idx = (self._next_idx - 1 - np.arange(batch_size)) % self._maxsize
+        self.rng.shuffle(idx)
         return idx
 
     def sample_index(self, idxes):
@@ -82,8 +115,532 @@ class ReplayBuffer(object):
         if batch_size > 0:
             idxes = self.make_index(batch_size)
         else:
-            idxes = range(0, len(self._storage))
+            idxes = range(0, len(self))
         return self._encode_sample(idxes)
 
     def collect(self):
         return self.sample(-1)
+
+
+# storage dtypes of the transition fields under each dtype policy. Floating point values
+# are cast to them when they are written; fields that are not listed, and integer values
+# (e.g. compact adjacency), are stored as they are added
+DTYPE_POLICIES = {
+    'float64': {},
+    'float32': dict(obs_t=np.float32, action=np.float32, reward=np.float32, obs_tp1=np.float32,
+                    done=np.float32, adj=np.uint8, adj_tp1=np.uint8),
+    'float16': dict(obs_t=np.float16, action=np.float16, reward=np.float32, obs_tp1=np.float16,
+                    done=np.float32, adj=np.uint8, adj_tp1=np.uint8),
+}
+
+
+# neighbour indices (..., k) of one-hot adjacency rows (..., k, num_classes), -1 for
+# the all-zero rows of missing neighbours
+def one_hot_to_neighbors(adj):
+    adj = np.asarray(adj)
+    neighbors = np.argmax(adj, axis=-1).astype(np.int16)
+    neighbors[~np.any(adj, axis=-1)] = -1
+    return neighbors
+
+
+class ArrayReplayBuffer(ReplayBuffer):
+    # names of the fields of a transition, in the order of add and of the sampled batches
+    fields = ('obs_t', 'action', 'reward', 'obs_tp1', 'done', 'adj', 'adj_tp1')
+    adj_fields = ('adj', 'adj_tp1')
+
+    def __init__(self, size, seed=None, compact_adj=False, dtype_policy='float32'):
+        """Create a replay buffer backed by preallocated arrays.
+
+        Every field of a transition (obs_t, action, reward, obs_tp1, done, adj,
+        adj_tp1) is kept in one (size, ...) ring array, allocated with the shape
+        and dtype of the first transition added, e.g. (size, n_agents, obs_dim)
+        for the observations of a species. All later transitions must have the
+        same shapes. Sampling gathers each field with one indexing operation.
+
+        Parameters
+        ----------
+        size: int
+            Max number of transitions to store in the buffer. When the buffer
+            overflows the old memories are dropped.
+        seed: int or None
+            Seed of the random generator used to sample indices.
+        compact_adj: bool
+            Store the one-hot adjacency matrices (n_agents, k, n_species) as int16
+            neighbour indices (n_agents, k), -1 for missing neighbours, and expand
+            them back to one-hot matrices when sampling.
+        dtype_policy: str
+            Storage dtypes, one of DTYPE_POLICIES: 'float32' stores floats as
+            float32 and the one-hot adjacency as uint8, 'float16' also stores the
+            observations and actions as float16, 'float64' keeps the values as
+            they are added. Sampled batches have the storage dtypes, the one-hot
+            adjacency matrices of compact_adj included.
+        """
+        self._maxsize = int(size)
+        self._arrays = None
+        self._next_idx = 0
+        self._size = 0
+        self._compact_adj = compact_adj
+        # width of the one-hot adjacency rows, when they are stored as indices
+        self._adj_classes = None
+        self._dtypes = DTYPE_POLICIES[dtype_policy]
+        self.seed(seed)
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        self._next_idx = 0
+        self._size = 0
+
+    # allocate the storage of every field from the values of the first transition
+    def _allocate(self, data):
+        self._arrays = []
+        for name, value in zip(self.fields, data):
+            value = np.asarray(value)
+            self._arrays.append(self._new_array(name, (self._maxsize,) + value.shape,
+                                                self._storage_dtype(name, value.dtype)))
+
+    # dtype of the storage of a field, for values of the given dtype
+    def _storage_dtype(self, name, dtype):
+        if np.issubdtype(dtype, np.floating):
+            return np.dtype(self._dtypes.get(name, dtype))
+        return dtype
+
+    # zero-filled storage of one field
+    def _new_array(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    # the values of a transition as they are stored
+    def _pack(self, data):
+        if not self._compact_adj:
+            return data
+        data = list(data)
+        for i, name in enumerate(self.fields):
+            if name in self.adj_fields:
+                if self._adj_classes is None:
+                    self._adj_classes = np.shape(data[i])[-1]
+                    assert self._adj_classes <= np.iinfo(np.int16).max, "too many agents for int16 neighbour indices."
+                data[i] = one_hot_to_neighbors(data[i])
+        return data
+
+    # the sampled batch of every field from the stored values
+    def _unpack(self, batch):
+        if not self._compact_adj:
+            return tuple(batch)
+        return tuple(self._expand_adj(name, value) if name in self.adj_fields else value
+                     for name, value in zip(self.fields, batch))
+
+    # one-hot adjacency (..., k, num_classes) of stored neighbour indices, gathered from the
+    # rows of an identity matrix whose last row (index -1) is zero
+    def _expand_adj(self, name, neighbors):
+        dtype = self._storage_dtype(name, np.dtype(np.float64))
+        table = np.eye(self._adj_classes + 1, self._adj_classes, dtype=dtype)
+        return np.take(table, neighbors, axis=0)
+
+    def add(self, obs_t, action, reward, obs_tp1, done, adj, adj_tp1):
+        data = self._pack((obs_t, action, reward, obs_tp1, done, adj, adj_tp1))
+
+        if self._arrays is None:
+            self._allocate(data)
+        for array, value in zip(self._arrays, data):
+            array[self._next_idx] = value
+        self._next_idx = (self._next_idx + 1) % self._maxsize
+        self._size = min(self._size + 1, self._maxsize)
+
+    def _encode_sample(self, idxes):
+        idxes = np.asarray(idxes, dtype=np.int64)
+        return self._unpack([array[idxes] for array in self._arrays])
+
+
+class FrameReplayBuffer(ArrayReplayBuffer):
+    # fields rebuilt from the frame that follows the transition, and the stored field they read
+    next_fields = {'obs_tp1': 'obs_t', 'adj_tp1': 'adj'}
+
+    def __init__(self, size, seed=None, compact_adj=False, dtype_policy='float32'):
+        """Create a replay buffer that stores every observation once.
+
+        The buffer is a ring of size frames. A frame holds the observations and
+        the adjacency of one timestep; the frame of obs_t also holds the action,
+        reward and done of the transition taken from it, and obs_tp1 and adj_tp1
+        are read from the next frame. Within an episode the obs_tp1 of a step is
+        the obs_t of the following one, so they are written once. The last
+        obs_tp1 of an episode gets a frame without a transition, which is never
+        sampled, so the buffer holds up to size - 1 transitions (fewer by one
+        per stored episode).
+
+        add takes episode_end=True for the last transition of an episode, e.g.
+        when the environment is reset after it. Otherwise obs_t and adj of the
+        next add are assumed to equal the obs_tp1 and adj_tp1 of this one.
+
+        Parameters
+        ----------
+        size: int
+            Number of frames in the ring. When the buffer overflows the old
+            memories are dropped.
+        seed: int or None
+            Seed of the random generator used to sample indices.
+        compact_adj: bool
+            Store the adjacency as neighbour indices, see ArrayReplayBuffer.
+        dtype_policy: str
+            Storage dtypes, see ArrayReplayBuffer.
+        """
+        super(FrameReplayBuffer, self).__init__(size, seed, compact_adj, dtype_policy)
+        # frames that start a stored transition
+        self._valid = np.zeros(self._maxsize, dtype=bool)
+        # number of frames written so far (up to size) and whether the next add starts an episode
+        self._filled = 0
+        self._episode_start = True
+
+    def clear(self):
+        super(FrameReplayBuffer, self).clear()
+        self._valid[:] = False
+        self._filled = 0
+        self._episode_start = True
+
+    # storage for the fields that are not rebuilt from the next frame
+    def _allocate(self, data):
+        self._arrays = []
+        for name, value in zip(self.fields, data):
+            value = np.asarray(value)
+            self._arrays.append(None if name in self.next_fields else
+                                self._new_array(name, (self._maxsize,) + value.shape,
+                                                self._storage_dtype(name, value.dtype)))
+
+    # write the given fields of a frame, dropping the transition it held
+    def _write_frame(self, idx, values, valid):
+        for array, value in zip(self._arrays, values):
+            if array is not None and value is not None:
+                array[idx] = value
+        self._size += int(valid) - int(self._valid[idx])
+        self._valid[idx] = valid
+        self._filled = max(self._filled, idx + 1)
+
+    def add(self, obs_t, action, reward, obs_tp1, done, adj, adj_tp1, episode_end=False):
+        data = dict(zip(self.fields, self._pack((obs_t, action, reward, obs_tp1, done, adj, adj_tp1))))
+
+        if self._arrays is None:
+            self._allocate([data[name] for name in self.fields])
+        # _next_idx is the frame holding the last obs_tp1, a new episode starts after it
+        idx = self._next_idx
+        frame_fields = dict((stored, name) for name, stored in self.next_fields.items())
+        if self._episode_start:
+            idx = (idx + 1) % self._maxsize if self._filled > 0 else 0
+            self._write_frame(idx, [data[name] for name in self.fields], True)
+        else:
+            # obs_t and adj are in the frame already, as the obs_tp1 and adj_tp1 of the last add
+            self._write_frame(idx, [None if name in frame_fields else data[name] for name in self.fields], True)
+        next_idx = (idx + 1) % self._maxsize
+        self._write_frame(next_idx, [data[frame_fields[name]] if name in frame_fields else None
+                                     for name in self.fields], False)
+        self._next_idx = next_idx
+        self._episode_start = episode_end
+
+    def make_index(self, batch_size, replace=True, chunk=None):
+        """Sample the indices of a batch of transitions, see ReplayBuffer.make_index.
+
+        Frames without a transition are drawn again.
+        """
+        if not replace and chunk is None:
+            return self.rng.choice(np.flatnonzero(self._valid), batch_size, replace=False)
+        if chunk is not None:
+            starts = self.rng.integers(0, self._filled, -(-batch_size // chunk))
+            idxes = ((starts[:, None] + np.arange(chunk)) % self._filled).reshape(-1)[:batch_size]
+        else:
+            idxes = self.rng.integers(0, self._filled, batch_size)
+        invalid = ~self._valid[idxes]
+        while np.any(invalid):
+            idxes[invalid] = self.rng.integers(0, self._filled, np.sum(invalid))
+            invalid = ~self._valid[idxes]
+        return idxes
+
+    def make_latest_index(self, batch_size):
+        # at most one frame in two is not a transition
+        idx = (self._next_idx - 1 - np.arange(min(2 * batch_size, self._filled))) % self._maxsize
+        idx = idx[self._valid[idx]][:batch_size]
+        self.rng.shuffle(idx)
+        return idx
+
+    def sample(self, batch_size):
+        if batch_size > 0:
+            return super(FrameReplayBuffer, self).sample(batch_size)
+        return self._encode_sample(np.flatnonzero(self._valid))
+
+    def _encode_sample(self, idxes):
+        idxes = np.asarray(idxes, dtype=np.int64)
+        next_idxes = (idxes + 1) % self._maxsize
+        arrays = dict(zip(self.fields, self._arrays))
+        return self._unpack([arrays[self.next_fields[name]][next_idxes] if name in self.next_fields
+                             else arrays[name][idxes] for name in self.fields])
+
+
+class PrioritizedReplayBuffer(ArrayReplayBuffer):
+    def __init__(self, size, alpha=0.6, seed=None, compact_adj=False, dtype_policy='float32'):
+        """Create an array-backed Prioritized Replay buffer.
+
+        Transitions are sampled in proportion to priority ** alpha, with the
+        priorities kept in a sum tree (and their minimum in a min tree) so that
+        sampling and updating a batch are O(batch_size * log(size)). New
+        transitions get the highest priority seen so far.
+
+        Parameters
+        ----------
+        size: int
+            Max number of transitions to store in the buffer. When the buffer
+            overflows the old memories are dropped.
+        alpha: float
+            how much prioritization is used
+            (0 - no prioritization, 1 - full prioritization)
+        seed: int or None
+            Seed of the random generator used to sample indices.
+        compact_adj: bool
+            Store the adjacency as neighbour indices, see ArrayReplayBuffer.
+        dtype_policy: str
+            Storage dtypes, see ArrayReplayBuffer.
+        """
+        super(PrioritizedReplayBuffer, self).__init__(size, seed, compact_adj, dtype_policy)
+        assert alpha >= 0
+        self._alpha = alpha
+        self._it_capacity = 1
+        while self._it_capacity < self._maxsize:
+            self._it_capacity *= 2
+        self._it_sum = SumSegmentTree(self._it_capacity)
+        self._it_min = MinSegmentTree(self._it_capacity)
+        self._max_priority = 1.0
+
+    def clear(self):
+        super(PrioritizedReplayBuffer, self).clear()
+        self._it_sum = SumSegmentTree(self._it_capacity)
+        self._it_min = MinSegmentTree(self._it_capacity)
+        self._max_priority = 1.0
+
+    def add(self, obs_t, action, reward, obs_tp1, done, adj, adj_tp1):
+        idx = self._next_idx
+        super(PrioritizedReplayBuffer, self).add(obs_t, action, reward, obs_tp1, done, adj, adj_tp1)
+        self._it_sum[idx] = self._max_priority ** self._alpha
+        self._it_min[idx] = self._max_priority ** self._alpha
+
+    def make_index(self, batch_size, replace=True, chunk=None):
+        """Sample the indices of a batch of transitions in proportion to their priorities.
+
+        The total priority is split into batch_size equal segments and one index
+        is drawn from each (stratified sampling). The signature is the one of
+        ReplayBuffer.make_index, but a transition can always be drawn more than
+        once and batches are not made of runs: replace=False and chunk raise a
+        ValueError.
+        """
+        if not replace:
+            raise ValueError('prioritized replay samples with replacement, replace=False is not supported')
+        if chunk is not None:
+            raise ValueError('prioritized replay samples single transitions, chunk is not supported')
+        mass = (np.arange(batch_size) + self.rng.random(batch_size)) * (self._it_sum.sum() / batch_size)
+        return np.minimum(self._it_sum.find_prefixsum_idx(mass), len(self) - 1)
+
+    def importance_weights(self, idxes, beta):
+        """Importance sampling weights of the sampled transitions.
+
+        Parameters
+        ----------
+        idxes: [int]
+            indices of the sampled transitions
+        beta: float
+            To what degree to use importance weights
+            (0 - no corrections, 1 - full correction)
+
+        Returns
+        -------
+        weights: np.array
+            (batch_size,) weights, normalized so that the largest possible weight is 1
+        """
+        assert beta > 0
+        p_min = self._it_min.min() / self._it_sum.sum()
+        max_weight = (p_min * len(self)) ** (-beta)
+        p_sample = self._it_sum[idxes] / self._it_sum.sum()
+        return (p_sample * len(self)) ** (-beta) / max_weight
+
+    def update_priorities(self, idxes, priorities):
+        """Update priorities of sampled transitions.
+
+        Parameters
+        ----------
+        idxes: [int]
+            indices of the sampled transitions
+        priorities: [float]
+            new (positive) priorities of the transitions, e.g. their absolute TD errors
+        """
+        idxes = np.asarray(idxes, dtype=np.int64)
+        priorities = np.asarray(priorities, dtype=np.float64)
+        assert np.all(priorities > 0)
+        assert np.all((0 <= idxes) & (idxes < len(self)))
+        self._it_sum[idxes] = priorities ** self._alpha
+        self._it_min[idxes] = priorities ** self._alpha
+        self._max_priority = max(self._max_priority, np.max(priorities))
+
+
+class MemmapReplayBuffer(ArrayReplayBuffer):
+    def __init__(self, size, path, readonly=False, seed=None, compact_adj=False, dtype_policy='float32'):
+        """Create or reopen a replay buffer stored in memory-mapped files.
+
+        The buffer lives in the directory path: one .npy file per field, created
+        when the first transition is added, and header.npy with the capacity, the
+        write index, the number of stored transitions and the width of compact
+        adjacency rows (0 if the adjacency is stored dense). The header is updated
+        after the fields of a transition are written, so a buffer reopened after
+        a crash keeps every transition added before it (except the slot that
+        was being overwritten, once the buffer is full). Other processes can
+        open the same directory with readonly=True and sample what the writer
+        has stored so far.
+
+        Parameters
+        ----------
+        size: int or None
+            Max number of transitions to store in the buffer. When the buffer
+            overflows the old memories are dropped. None takes the capacity of
+            an existing buffer.
+        path: str
+            Directory of the buffer files, created if needed.
+        readonly: bool
+            Open an existing buffer for sampling only.
+        seed: int or None
+            Seed of the random generator used to sample indices.
+        compact_adj: bool
+            Store the adjacency as neighbour indices, see ArrayReplayBuffer.
+            An existing buffer keeps the layout it was created with.
+        dtype_policy: str
+            Storage dtypes, see ArrayReplayBuffer. An existing buffer keeps the
+            dtypes of its files.
+        """
+        self.path = path
+        self._dtypes = DTYPE_POLICIES[dtype_policy]
+        self.readonly = readonly
+        header_path = os.path.join(path, 'header.npy')
+        if os.path.exists(header_path):
+            self._header = np.load(header_path, mmap_mode='r' if readonly else 'r+')
+            if size is not None and int(size) != self._header[0]:
+                raise ValueError('the replay buffer in {} has size {}, not {}'.format(path, self._header[0], int(size)))
+        elif readonly or size is None:
+            raise IOError('no replay buffer in {}'.format(path))
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._header = np.lib.format.open_memmap(header_path, mode='w+', dtype=np.int64, shape=(4,))
+            self._header[0] = int(size)
+        self._maxsize = int(self._header[0])
+        self._arrays = None
+        self._compact_adj = compact_adj
+        self._open_arrays()
+        self.seed(seed)
+
+    # write index and number of transitions, kept in the header
+    @property
+    def _next_idx(self):
+        return int(self._header[1])
+
+    @_next_idx.setter
+    def _next_idx(self, value):
+        self._header[1] = value
+
+    @property
+    def _size(self):
+        return int(self._header[2])
+
+    @_size.setter
+    def _size(self, value):
+        self._header[2] = value
+
+    @property
+    def _adj_classes(self):
+        return int(self._header[3]) or None
+
+    @_adj_classes.setter
+    def _adj_classes(self, value):
+        self._header[3] = value or 0
+
+    def _field_path(self, name):
+        return os.path.join(self.path, name + '.npy')
+
+    # map the field files, once the first transition has been written, and take the
+    # adjacency layout they were written with
+    def _open_arrays(self):
+        if all(os.path.exists(self._field_path(name)) for name in self.fields):
+            self._arrays = [np.load(self._field_path(name), mmap_mode='r' if self.readonly else 'r+')
+                            for name in self.fields]
+            self._compact_adj = self._adj_classes is not None
+
+    def _new_array(self, name, shape, dtype):
+        return np.lib.format.open_memmap(self._field_path(name), mode='w+', dtype=dtype, shape=shape)
+
+    def add(self, obs_t, action, reward, obs_tp1, done, adj, adj_tp1):
+        if self.readonly:
+            raise ValueError('the replay buffer in {} is opened read-only'.format(self.path))
+        super(MemmapReplayBuffer, self).add(obs_t, action, reward, obs_tp1, done, adj, adj_tp1)
+
+    def _encode_sample(self, idxes):
+        if self._arrays is None:
+            self._open_arrays()
+        return super(MemmapReplayBuffer, self)._encode_sample(idxes)
+
+    def flush(self):
+        """Write the buffer to disk."""
+        self._header.flush()
+        for array in self._arrays or []:
+            array.flush()
+
+
+class JointReplayBuffer(object):
+    def __init__(self, buffers):
+        """Replay of several species written in lockstep, sampled with one index.
+
+        Slot i of every species buffer holds the transition of that species at the
+        same timestep, so a batch is one index into all of them. shared_sample
+        gathers the batch of a training step once for all the trainers, which
+        then train on the same minibatch (their critics see correlated batches,
+        unlike trainers that draw their own index); it is opt-in in train.py
+        with --shared-replay-batch.
+
+        Parameters
+        ----------
+        buffers: [ReplayBuffer]
+            buffers of the species, in the order of the trainers; they must
+            receive one transition per timestep each. Indices are drawn from
+            the first one.
+        """
+        self.buffers = buffers
+        self._batch_key = None
+        self._batch = None
+
+    def __len__(self):
+        return len(self.buffers[0])
+
+    def add(self, transitions, **kwargs):
+        """Store the transition (obs_t, action, reward, obs_tp1, done, adj, adj_tp1) of every species."""
+        for buffer, transition in zip(self.buffers, transitions):
+            buffer.add(*transition, **kwargs)
+
+    def make_index(self, batch_size, **kwargs):
+        return self.buffers[0].make_index(batch_size, **kwargs)
+
+    def sample_index(self, idxes):
+        """Sample the given transitions of every species.
+
+        Returns
+        -------
+        samples: [tuple]
+            per species, the batch (obs, act, rew, obs_next, done, adj, adj_next)
+        """
+        return [buffer.sample_index(idxes) for buffer in self.buffers]
+
+    def shared_sample(self, batch_size, key):
+        """Batch of training step key, sampled on the first call with that key.
+
+        Returns
+        -------
+        idxes: np.array
+            indices of the sampled transitions
+        samples: [tuple]
+            per species, the batch (obs, act, rew, obs_next, done, adj, adj_next)
+        """
+        if self._batch is None or self._batch_key != key:
+            idxes = self.make_index(batch_size)
+            self._batch = (idxes, self.sample_index(idxes))
+            self._batch_key = key
+        return self._batch
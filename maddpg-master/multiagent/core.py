@@ -1,13 +1,52 @@
 import numpy as np
+from multiagent.spatial import grid_pairs
+
+# attribute that becomes a view of a row of the world arrays once bound;
+# assigning to a bound attribute writes into the row instead of rebinding it.
+# Assignments to a state attribute (moved=True) are counted in EntityState.moves
+def _array_view(name, moved=False):
+    key = '_' + name
+    def fget(self):
+        return getattr(self, key)
+    def fset(self, value):
+        if self._bound:
+            getattr(self, key)[...] = value
+        else:
+            setattr(self, key, value)
+        if moved:
+            EntityState.moves += 1
+    return property(fget, fset)
 
 # physical/external base state of all entites
 class EntityState(object):
+    p_pos = _array_view('p_pos', moved=True)
+    p_vel = _array_view('p_vel', moved=True)
+    # assignments to the position or velocity of any entity so far (including +=),
+    # a World.geometry taken at another count is stale
+    moves = 0
+
     def __init__(self):
+        self._bound = False
         # physical position
         self.p_pos = None
         # physical velocity
         self.p_vel = None
 
+    # share storage with rows of the world arrays, keeping the current values
+    def bind(self, p_pos, p_vel):
+        if self._p_pos is not None:
+            p_pos[...] = self._p_pos
+        if self._p_vel is not None:
+            p_vel[...] = self._p_vel
+        self._p_pos, self._p_vel = p_pos, p_vel
+        self._bound = True
+
+    # go back to owning private copies of the state
+    def unbind(self):
+        if self._bound:
+            self._p_pos, self._p_vel = self._p_pos.copy(), self._p_vel.copy()
+            self._bound = False
+
 # state of agents (including communication and internal/mental state)
 class AgentState(EntityState):
     def __init__(self):
@@ -17,12 +56,27 @@ class AgentState(EntityState):
 
 # action of the agent
 class Action(object):
+    u = _array_view('u')
+
     def __init__(self):
+        self._bound = False
         # physical action
         self.u = None
         # communication action
         self.c = None
 
+    # share storage of the physical action with a row of the world arrays
+    def bind(self, u):
+        if self._u is not None:
+            u[...] = self._u
+        self._u = u
+        self._bound = True
+
+    def unbind(self):
+        if self._bound:
+            self._u = self._u.copy()
+            self._bound = False
+
 # properties and state of physical world entity
 class Entity(object):
     def __init__(self):
@@ -78,6 +132,65 @@ class Agent(Entity):
         # script behavior to execute
         self.action_callback = None
 
+# pairwise geometry of the entities (agents first, then landmarks) for one world
+# state, with any leading world dimensions. Matrices are computed on first use and
+# shared by observations, rewards, adjacency and rendering until the state changes.
+class WorldGeometry(object):
+    def __init__(self, entities, p_pos, p_vel, size, n_agents):
+        self.entities = entities
+        # (..., n_entities, dim_p) state and (n_entities,) sizes
+        self.p_pos = p_pos
+        self.p_vel = p_vel
+        self.size = size
+        self.n_agents = n_agents
+        # values derived from this state by the scenario (e.g. reward terms shared by all agents)
+        self.cache = {}
+        self._index = None
+        self._delta = None
+        self._dist2 = None
+        self._dist = None
+        self._overlap = None
+
+    # row of an entity in the matrices
+    def index(self, entity):
+        if self._index is None:
+            self._index = dict((id(e), i) for i, e in enumerate(self.entities))
+        return self._index[id(entity)]
+
+    # delta[..., i, j] = p_pos[j] - p_pos[i], position of j relative to i
+    @property
+    def delta(self):
+        if self._delta is None:
+            self._delta = self.p_pos[..., None, :, :] - self.p_pos[..., :, None, :]
+        return self._delta
+
+    @property
+    def dist2(self):
+        if self._dist2 is None:
+            self._dist2 = np.sum(np.square(self.delta), axis=-1)
+        return self._dist2
+
+    @property
+    def dist(self):
+        if self._dist is None:
+            self._dist = np.sqrt(self.dist2)
+        return self._dist
+
+    # overlap[..., i, j]: entities i and j are closer than the sum of their sizes
+    @property
+    def overlap(self):
+        if self._overlap is None:
+            self._overlap = self.dist < self.size[:, None] + self.size[None, :]
+        return self._overlap
+
+    @property
+    def agent_dist(self):
+        return self.dist[..., :self.n_agents, :self.n_agents]
+
+    @property
+    def agent_landmark_dist(self):
+        return self.dist[..., :self.n_agents, self.n_agents:]
+
 # multi-agent world
 class World(object):
     def __init__(self):
@@ -97,6 +210,19 @@ class World(object):
         # contact response parameters
         self.contact_force = 1e+2
         self.contact_margin = 1e-3
+        # keep entity state in contiguous arrays and step it with vectorized kernels
+        self.array_mode = False
+        self._array_entities = None
+        self._contact_pairs_key = None
+        # pairwise geometry of the current state, see World.geometry
+        self._geometry = None
+        self._geometry_moves = None
+        # collision broad phase: 'brute' checks every pair, 'grid' only pairs in
+        # neighbouring cells of a uniform grid (for large worlds)
+        self.collision_broadphase = 'brute'
+        # contacts further apart than this many contact margins are ignored by the grid
+        # (the softplus penetration has decayed below exp(-20) there)
+        self.broadphase_cutoff = 20.0
 
     # return all entities in the world composed of agents and landmarks
     @property
@@ -113,23 +239,135 @@ class World(object):
     def scripted_agents(self):
         return [agent for agent in self.agents if agent.action_callback is not None]
 
+    # geometry of the current state, computed once and dropped by step(), by any
+    # assignment to an entity's p_pos / p_vel (e.g. in reset_world) and by
+    # invalidate_geometry() (only needed after writing into the state arrays in place)
+    @property
+    def geometry(self):
+        if self._geometry is None or self._geometry_moves != EntityState.moves:
+            self._geometry_moves = EntityState.moves
+            entities = self.entities
+            if self.array_mode and self._array_entities == entities:
+                p_pos, p_vel, size = self.p_pos.copy(), self.p_vel.copy(), self.entity_size
+            else:
+                p_pos = np.array([entity.state.p_pos for entity in entities], dtype=float)
+                p_vel = np.array([entity.state.p_vel for entity in entities], dtype=float)
+                size = np.array([entity.size for entity in entities], dtype=float)
+            self._geometry = WorldGeometry(entities, p_pos, p_vel, size, len(self.agents))
+        return self._geometry
+
+    def invalidate_geometry(self):
+        self._geometry = None
+
+    # utterances (n_agents, dim_c) of all agents
+    def agent_comm(self):
+        return np.array([agent.state.c for agent in self.agents], dtype=float).reshape(len(self.agents), self.dim_c)
+
+    # the geometry is keyed by entity identity, copies and pickles start without it
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_geometry'] = None
+        return state
+
+    # allocate the entity arrays and bind entity and action state to their rows
+    # (entity properties are read here, call again after changing them)
+    def build_arrays(self):
+        entities = self.entities
+        n = len(entities)
+        self.p_pos = np.zeros((n, self.dim_p))
+        self.p_vel = np.zeros((n, self.dim_p))
+        self.p_action = np.zeros((n, self.dim_p))
+        for i, entity in enumerate(entities):
+            entity.state.bind(self.p_pos[i], self.p_vel[i])
+        for i, agent in enumerate(self.agents):
+            agent.action.bind(self.p_action[i])
+        self.build_property_arrays()
+
+    # per-entity property arrays shared by all rows of the state arrays
+    def build_property_arrays(self):
+        entities = self.entities
+        self.entity_mass = np.array([entity.mass for entity in entities], dtype=float)
+        self.entity_size = np.array([entity.size for entity in entities], dtype=float)
+        self.entity_max_speed = np.array([np.inf if entity.max_speed is None else entity.max_speed
+                                          for entity in entities], dtype=float)
+        self.entity_movable = np.array([entity.movable for entity in entities], dtype=bool)
+        self.entity_collide = np.array([entity.collide for entity in entities], dtype=bool)
+        self.entity_u_noise = np.array([getattr(entity, 'u_noise', None) or 0.0 for entity in entities], dtype=float)
+        self._movable_idx = np.flatnonzero(self.entity_movable)
+        self._contact_pairs = self.get_contact_pairs(self.entity_collide, self.entity_movable)
+        self._noise_idx = np.flatnonzero(self.entity_movable & (self.entity_u_noise > 0))
+        self._scripted_idx = [i for i, agent in enumerate(self.agents) if agent.action_callback is not None]
+        self._array_entities = entities
+
     # update state of the world
     def step(self):
         # set actions for scripted agents 
         for agent in self.scripted_agents:
             agent.action = agent.action_callback(agent, self)
-        # gather forces applied to entities
-        p_force = [None] * len(self.entities)
-        # apply agent physical controls
-        p_force = self.apply_action_force(p_force)
-        # apply environment forces
-        p_force = self.apply_environment_force(p_force)
-        # integrate physical state
-        self.integrate_state(p_force)
+        self.invalidate_geometry()
+        if self.array_mode:
+            self.step_arrays()
+        else:
+            # gather forces applied to entities
+            p_force = [None] * len(self.entities)
+            # apply agent physical controls
+            p_force = self.apply_action_force(p_force)
+            # apply environment forces
+            p_force = self.apply_environment_force(p_force)
+            # integrate physical state
+            self.integrate_state(p_force)
         # update agent state
         for agent in self.agents:
             self.update_agent_state(agent)
 
+    # physics step on the entity arrays, one kernel per phase
+    def step_arrays(self):
+        if self._array_entities != self.entities:
+            self.build_arrays()
+        # scripted agents replace their action object every step
+        for i in self._scripted_idx:
+            self.agents[i].action.bind(self.p_action[i])
+        p_force = self.apply_action_force_arrays()
+        p_force = self.apply_environment_force_arrays(p_force)
+        self.integrate_state_arrays(p_force)
+
+    # gather agent action forces into an (n_entities, dim_p) array
+    def apply_action_force_arrays(self):
+        p_force = self.p_action.copy()
+        p_force[..., ~self.entity_movable, :] = 0.0
+        for i in self._noise_idx:
+            p_force[..., i, :] += np.random.randn(*p_force[..., i, :].shape) * self.entity_u_noise[i]
+        return p_force
+
+    # add contact forces between all colliding entities
+    def apply_environment_force_arrays(self, p_force):
+        if self.collision_broadphase == 'grid':
+            # flatten any leading world dimensions, the grid keeps the worlds apart
+            n = len(self.entity_size)
+            n_worlds = int(np.prod(self.p_pos.shape[:-2]))
+            p_pos = self.p_pos.reshape(-1, self.dim_p)
+            size = np.tile(self.entity_size, n_worlds)
+            movable = np.tile(self.entity_movable, n_worlds)
+            pair_a, pair_b = self.get_grid_contact_pairs(p_pos, size, np.tile(self.entity_collide, n_worlds),
+                                                         movable, np.repeat(np.arange(n_worlds), n))
+            self.apply_contact_forces(p_force.reshape(-1, self.dim_p), p_pos, size, movable, pair_a, pair_b)
+            return p_force
+        pair_a, pair_b = self._contact_pairs
+        return self.apply_contact_forces(p_force, self.p_pos, self.entity_size, self.entity_movable, pair_a, pair_b)
+
+    # integrate the movable rows of the entity arrays
+    def integrate_state_arrays(self, p_force):
+        idx = self._movable_idx
+        p_vel = self.p_vel[..., idx, :] * (1 - self.damping)
+        p_vel += (p_force[..., idx, :] / self.entity_mass[idx, None]) * self.dt
+        speed = np.sqrt(np.sum(np.square(p_vel), axis=-1))
+        max_speed = np.broadcast_to(self.entity_max_speed[idx], speed.shape)
+        over = speed > max_speed  # project to the max_speed with the same proportion
+        if np.any(over):
+            p_vel[over] = p_vel[over] / speed[over][:, None] * max_speed[over][:, None]
+        self.p_vel[..., idx, :] = p_vel
+        self.p_pos[..., idx, :] += p_vel * self.dt
+
     # gather agent action forces
     def apply_action_force(self, p_force):
         # set applied forces
@@ -141,6 +379,72 @@ class World(object):
 
     # gather physical forces acting on entities
     def apply_environment_force(self, p_force):
+        entities = self.entities
+        collide = np.array([entity.collide for entity in entities], dtype=bool)
+        movable = np.array([entity.movable for entity in entities], dtype=bool)
+        p_pos = np.array([entity.state.p_pos for entity in entities], dtype=float)
+        size = np.array([entity.size for entity in entities], dtype=float)
+        if self.collision_broadphase == 'grid':
+            pair_a, pair_b = self.get_grid_contact_pairs(p_pos, size, collide, movable)
+        else:
+            pair_a, pair_b = self.get_contact_pairs(collide, movable)
+        if len(pair_a) == 0:
+            return p_force
+        force = np.zeros_like(p_pos)
+        for i, f in enumerate(p_force):
+            if f is not None:
+                force[i] = f
+        force = self.apply_contact_forces(force, p_pos, size, movable, pair_a, pair_b)
+        # entities without action or contact forces keep None
+        touched = np.zeros(len(entities), dtype=bool)
+        touched[pair_a[movable[pair_a]]] = True
+        touched[pair_b[movable[pair_b]]] = True
+        for i in np.flatnonzero(touched):
+            p_force[i] = force[i]
+        return p_force
+
+    # entity pairs (a < b) that can exert a contact force on each other, in loop order
+    def get_contact_pairs(self, collide, movable):
+        key = (collide.tobytes(), movable.tobytes())
+        if self._contact_pairs_key != key:
+            pair_a, pair_b = np.triu_indices(len(collide), k=1)
+            mask = collide[pair_a] & collide[pair_b] & (movable[pair_a] | movable[pair_b])
+            self._contact_pairs_cache = (pair_a[mask], pair_b[mask])
+            self._contact_pairs_key = key
+        return self._contact_pairs_cache
+
+    # contact pairs (a < b) found by the spatial hash broad phase, in loop order;
+    # group keeps entities of different worlds apart when the arrays are flattened
+    def get_grid_contact_pairs(self, p_pos, size, collide, movable, group=None):
+        idx = np.flatnonzero(collide)
+        if len(idx) < 2:
+            return idx[:0], idx[:0]
+        cell_size = 2 * np.max(size[idx]) + self.broadphase_cutoff * self.contact_margin
+        pair_a, pair_b = grid_pairs(p_pos[idx], cell_size, None if group is None else group[idx])
+        pair_a, pair_b = idx[pair_a], idx[pair_b]
+        mask = movable[pair_a] | movable[pair_b]
+        return pair_a[mask], pair_b[mask]
+
+    # batched contact solver: forces for all pairs in one pass, scatter-added into p_force
+    def apply_contact_forces(self, p_force, p_pos, size, movable, pair_a, pair_b):
+        # compute actual distance between entities
+        delta_pos = p_pos[..., pair_a, :] - p_pos[..., pair_b, :]
+        dist = np.sqrt(np.sum(np.square(delta_pos), axis=-1))
+        # minimum allowable distance
+        dist_min = size[pair_a] + size[pair_b]
+        # softmax penetration
+        k = self.contact_margin
+        penetration = np.logaddexp(0, -(dist - dist_min)/k)*k
+        force = self.contact_force * delta_pos / dist[..., None] * penetration[..., None]
+        # interleave (+force on a, -force on b) so every entity sums its contacts in loop order
+        index = np.stack([pair_a, pair_b], axis=-1).reshape(-1)
+        force = np.stack([force, -force], axis=-2).reshape(force.shape[:-2] + (-1, force.shape[-1]))
+        keep = movable[index]
+        np.add.at(p_force, (Ellipsis, index[keep], slice(None)), force[..., keep, :])
+        return p_force
+
+    # reference collision response, one get_collision_force call per entity pair
+    def apply_environment_force_pairwise(self, p_force):
         # simple (but inefficient) collision response
         for a,entity_a in enumerate(self.entities):
             for b,entity_b in enumerate(self.entities):  # if entity is not movable, then the force exert on it is None
@@ -194,4 +498,72 @@ class World(object):
         force = self.contact_force * delta_pos / dist * penetration
         force_a = +force if entity_a.movable else None
         force_b = -force if entity_b.movable else None
-        return [force_a, force_b]
\ No newline at end of file
+        return [force_a, force_b]
+
+# several copies of the same world stepped together: state arrays get a leading
+# (n_worlds,) dimension and each copy's entities are bound to their slice
+class BatchedWorld(World):
+    def __init__(self, worlds):
+        super(BatchedWorld, self).__init__()
+        self.worlds = worlds
+        template = worlds[0]
+        for key in ['dim_c', 'dim_p', 'dim_color', 'dt', 'damping', 'contact_force', 'contact_margin',
+                    'collision_broadphase', 'broadphase_cutoff']:
+            setattr(self, key, getattr(template, key))
+        # entity properties are taken from the first copy
+        self.agents = template.agents
+        self.landmarks = template.landmarks
+        self.array_mode = True
+        self.build_arrays()
+
+    # scenario specific world properties (observing_range, ...) come from the first copy
+    def __getattr__(self, name):
+        worlds = self.__dict__.get('worlds')
+        if worlds is None or name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(worlds[0], name)
+
+    @property
+    def n_worlds(self):
+        return len(self.worlds)
+
+    def build_arrays(self):
+        n = len(self.entities)
+        shape = (len(self.worlds), n, self.dim_p)
+        self.p_pos = np.zeros(shape)
+        self.p_vel = np.zeros(shape)
+        self.p_action = np.zeros(shape)
+        for k, world in enumerate(self.worlds):
+            world.array_mode = False
+            for i, entity in enumerate(world.entities):
+                entity.state.bind(self.p_pos[k, i], self.p_vel[k, i])
+            for i, agent in enumerate(world.agents):
+                agent.action.bind(self.p_action[k, i])
+                # silent agents keep a zero utterance, it is not reset every step
+                if agent.silent:
+                    agent.state.c = np.zeros(self.dim_c)
+        self.build_property_arrays()
+        self._talking_idx = [i for i, agent in enumerate(self.agents) if not agent.silent]
+
+    def agent_comm(self):
+        return np.array([world.agent_comm() for world in self.worlds])
+
+    def invalidate_geometry(self):
+        self._geometry = None
+        for world in self.worlds:
+            world.invalidate_geometry()
+
+    # step every copy with one set of array kernels
+    def step(self):
+        self.invalidate_geometry()
+        for i in self._scripted_idx:
+            for k, world in enumerate(self.worlds):
+                agent = world.agents[i]
+                agent.action = agent.action_callback(agent, world)
+                agent.action.bind(self.p_action[k, i])
+        p_force = self.apply_action_force_arrays()
+        p_force = self.apply_environment_force_arrays(p_force)
+        self.integrate_state_arrays(p_force)
+        for world in self.worlds:
+            for i in self._talking_idx:
+                world.update_agent_state(world.agents[i])
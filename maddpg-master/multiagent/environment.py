@@ -3,7 +3,8 @@ from gym import spaces
 from gym.envs.registration import EnvSpec
 import numpy as np
 from multiagent.multi_discrete import MultiDiscrete
-from keras.utils import np_utils,to_categorical
+from multiagent.core import BatchedWorld
+from multiagent.spatial import knn_indices, one_hot_neighbors, NeighborIndex
 
 # environment for all agents in the multiagent world
 # currently code assumes that no agents will be created/destroyed at runtime!
@@ -14,19 +15,36 @@ class MultiAgentEnv(gym.Env):
 
     def __init__(self, world, reset_callback=None, reward_callback=None,
                  observation_callback=None, info_callback=None,
-                 done_callback=None, shared_viewer=True):
+                 done_callback=None, shared_viewer=True, reward_all_callback=None,
+                 observation_all_callback=None, done_all_callback=None, reset_all_callback=None):
 
         self.world = world
         self.agents = self.world.policy_agents
+        # rows of the policy agents in world.agents
+        self._agent_idx = np.array([i for i, agent in enumerate(world.agents) if agent.action_callback is None],
+                                   dtype=int)
         # set required vectorized gym env property
         self.n = len(world.policy_agents)
         self.observe_field = 0.8
+        # if set, the adjacency of a single world is answered from Verlet neighbour
+        # lists with this skin (for large worlds), one index per species
+        self.neighbor_skin = world.neighbor_skin if hasattr(world, 'neighbor_skin') else None
+        self._neighbor_index = {}
+        # species layout of the adjacency, by neighbour counts, see _get_species
+        self._species = {}
+        # reused output buffers of step_arrays
+        self._obs_buf = None
         # scenario callbacks
         self.reset_callback = reset_callback
         self.reward_callback = reward_callback
         self.observation_callback = observation_callback
         self.info_callback = info_callback
         self.done_callback = done_callback
+        # optional whole-world callbacks, used instead of the per-agent ones when given
+        self.reward_all_callback = reward_all_callback
+        self.observation_all_callback = observation_all_callback
+        self.done_all_callback = done_all_callback
+        self.reset_all_callback = reset_all_callback
         # environment parameters
         self.discrete_action_space = True
         # if true, action is a number 0...N, otherwise action is a one-hot N-dimensional vector
@@ -72,6 +90,8 @@ class MultiAgentEnv(gym.Env):
             obs_dim = len(observation_callback(agent, self.world))
             self.observation_space.append(spaces.Box(low=-np.inf, high=+np.inf, shape=(obs_dim,), dtype=np.float32))
             agent.action.c = np.zeros(self.world.dim_c)
+        # column layout of the flat actions, for the batched decoder
+        self._build_action_layout()
 
         # rendering
         self.shared_viewer = shared_viewer
@@ -82,22 +102,17 @@ class MultiAgentEnv(gym.Env):
         self._reset_render()
 
     def step(self, action_n):
-        obs_n = []
-        reward_n = []
-        done_n = []
         info_n = {'n': []}
         self.agents = self.world.policy_agents
         # set action for each agent
-        for i, agent in enumerate(self.agents):  # pass the action command into each agent
-            self._set_action(action_n[i], agent, self.action_space[i])
+        self._set_actions(action_n)
         # advance world state
         self.world.step()
         # record observation for each agent
+        obs_n = self._get_obs_n()
+        reward_n = self._get_reward_n()
+        done_n = self._get_done_n()
         for agent in self.agents:
-            obs_n.append(self._get_obs(agent))
-            reward_n.append(self._get_reward(agent))
-            done_n.append(self._get_done(agent))
-
             info_n['n'].append(self._get_info(agent))
 
         # all agents get total reward in cooperative case
@@ -111,64 +126,155 @@ class MultiAgentEnv(gym.Env):
 
     def reset(self):
         # reset world
-        self.reset_callback(self.world)
+        self._reset_worlds([self.world])
+        self.world.invalidate_geometry()
         # reset renderer
         self._reset_render()
         # record observations for each agent
-        obs_n = []
         self.agents = self.world.policy_agents
-        for agent in self.agents:
-            obs_n.append(self._get_obs(agent))
+        obs_n = self._get_obs_n()
         adj_n = self._get_adj(self.world.neighbors_pred, self.world.neighbors_prey)
         return obs_n, adj_n
 
+    # array-in / array-out step: actions is one (n, act_dim) array and the observations
+    # (n, obs_dim), rewards (n,), dones (n,) and adjacency (n, k, m) are written into
+    # float32 buffers that every call reuses (copy what has to be kept). Rows of agents
+    # with fewer observations, neighbours or species members are zero padded. info_n is
+    # None when there is no info_callback
+    def step_arrays(self, actions):
+        self._set_actions(actions)
+        self.world.step()
+        if self._obs_buf is None:
+            self._build_array_buffers()
+        self._write_obs(self._obs_buf)
+        self._write_reward(self._rew_buf)
+        self._write_done(self._done_buf)
+        info_n = None
+        if self.info_callback is not None:
+            info_n = {'n': [self._get_info(agent) for agent in self.agents]}
+        self._write_adj()
+        return self._obs_buf, self._rew_buf, self._done_buf, info_n, self._adj_buf
+
+    # reset() counterpart of step_arrays, returns the reused observation and adjacency buffers
+    def reset_arrays(self):
+        self._reset_worlds([self.world])
+        self.world.invalidate_geometry()
+        self._reset_render()
+        if self._obs_buf is None:
+            self._build_array_buffers()
+        self._write_obs(self._obs_buf)
+        self._write_adj()
+        return self._obs_buf, self._adj_buf
+
+    # output buffers of step_arrays, with the given leading (world) dimensions
+    def _build_array_buffers(self, lead=()):
+        obs_dim = max([space.shape[0] for space in self.observation_space])
+        # the species layout is built here once and reused by every step
+        species = self._get_species(self.world.neighbors_pred, self.world.neighbors_prey)
+        neighbors = max([k for _, _, k, _ in species])
+        members = max([end - start for start, end, _, _ in species])
+        self._obs_buf = np.zeros(lead + (self.n, obs_dim), dtype=np.float32)
+        self._rew_buf = np.zeros(lead + (self.n,), dtype=np.float32)
+        self._done_buf = np.zeros(lead + (self.n,), dtype=np.float32)
+        self._adj_buf = np.zeros(lead + (self.n, neighbors, members), dtype=np.float32)
+        # adjacency of every species, written in place
+        self._adj_out = [self._adj_buf[..., start:end, :k, :end - start] for start, end, k, _ in species]
+
+    def _write_obs(self, out):
+        if self.observation_all_callback is not None:
+            obs = self.observation_all_callback(self.world)
+            if isinstance(obs, np.ndarray) and obs.shape[-1] == out.shape[-1]:
+                out[:] = obs[self._agent_idx]
+                return
+            for row, i in enumerate(self._agent_idx):
+                out[row, :len(obs[i])] = obs[i]
+            return
+        for row, agent in enumerate(self.agents):
+            obs = self._get_obs(agent)
+            out[row, :len(obs)] = obs
+
+    def _write_reward(self, out):
+        if self.reward_all_callback is not None:
+            reward = np.asarray(self.reward_all_callback(self.world), dtype=float)[self._agent_idx]
+        else:
+            reward = np.fromiter((self._get_reward(agent) for agent in self.agents), dtype=float, count=self.n)
+        # all agents get total reward in cooperative case
+        out[:] = np.sum(reward) if self.shared_reward else reward
+
+    def _write_done(self, out):
+        if self.done_all_callback is not None:
+            out[:] = self.done_all_callback(self.world)[self._agent_idx]
+            return
+        for row, agent in enumerate(self.agents):
+            out[row] = self._get_done(agent)
+
+    def _write_adj(self):
+        p_pos, dist2 = self._get_agent_pos()
+        self._get_species_adj(p_pos, self.world.neighbors_pred, self.world.neighbors_prey, dist2, self._adj_out)
+
     def _get_adj(self, n_pred, n_prey):
+        p_pos, dist2 = self._get_agent_pos()
         adj_n = []
-        n = self.n
-        num_adversaries = self.world.num_adversaries
-        for i, this_agent in enumerate(self.world.policy_agents[0:num_adversaries]):
-            neighbors = []
-            list = self.agents[0:num_adversaries]
-            p_pos_x = this_agent.state.p_pos[0]
-            p_pos_y = this_agent.state.p_pos[1]
-            neighbors = sorted(list, key=lambda x: (x.state.p_pos[0] - p_pos_x)
-                                                   * (x.state.p_pos[0] - p_pos_x)
-                                                   + (x.state.p_pos[1] - p_pos_y)
-                                                   * (x.state.p_pos[1] - p_pos_y))
-            neighbors = neighbors[0:n_pred]
-            for i, neighbor in enumerate(reversed(neighbors)):
-                if (((neighbor.state.p_pos[0] - p_pos_x) * (neighbor.state.p_pos[0] - p_pos_x)
-                    + (neighbor.state.p_pos[1] - p_pos_y) * (neighbor.state.p_pos[1] - p_pos_y))
-                        < self.observe_field * self.observe_field):
-                    break
-            neighbors = neighbors[0:n_pred - i]
-            neighbor_id = [x.id for x in neighbors]
-            adj_i = to_categorical(neighbor_id, num_classes=num_adversaries)
-            adj_i = np.append(adj_i, np.zeros([i, num_adversaries]), axis=0)
-            adj_n.append(adj_i)
-        for i, this_agent in enumerate(self.world.policy_agents[num_adversaries:self.n]):
-            neighbors = []
-            list = self.agents[num_adversaries:self.n]
-            p_pos_x = this_agent.state.p_pos[0]
-            p_pos_y = this_agent.state.p_pos[1]
-            neighbors = sorted(list, key=lambda x: (x.state.p_pos[0] - p_pos_x)
-                                                   * (x.state.p_pos[0] - p_pos_x)
-                                                   + (x.state.p_pos[1] - p_pos_y)
-                                                   * (x.state.p_pos[1] - p_pos_y))
-            neighbors = neighbors[0:n_prey]
-            for i, neighbor in enumerate(reversed(neighbors)):
-                if (((neighbor.state.p_pos[0] - p_pos_x) * (neighbor.state.p_pos[0] - p_pos_x)
-                    + (neighbor.state.p_pos[1] - p_pos_y) * (neighbor.state.p_pos[1] - p_pos_y))
-                        < self.observe_field * self.observe_field):
-                    break
-            neighbors = neighbors[0:n_prey - i]
-            neighbor_id = [x.id for x in neighbors]
-            adj_i = to_categorical(neighbor_id, num_classes=self.n)
-            adj_i = np.append(adj_i, np.zeros([i, self.n]), axis=0)
-            adj_i = adj_i[:, num_adversaries:]
-            adj_n.append(adj_i)
+        for adj in self._get_species_adj(p_pos, n_pred, n_prey, dist2):
+            adj_n.extend(adj)
         return adj_n
 
+    # reset the given worlds, all at once with reset_all_callback if there is one
+    def _reset_worlds(self, worlds):
+        if self.reset_all_callback is not None:
+            self.reset_all_callback(worlds)
+            return
+        for world in worlds:
+            self.reset_callback(world)
+
+    # positions (n, dim_p) of the policy agents, and their squared distances when they
+    # can be taken from the world geometry
+    def _get_agent_pos(self):
+        world = self.world
+        if world.array_mode and world._array_entities == world.entities:
+            p_pos = world.p_pos[self._agent_idx]
+        else:
+            p_pos = np.array([agent.state.p_pos for agent in self.agents])
+        # agent distances are shared with the scenario when no agents are scripted
+        # (and nobody has moved the agents since the geometry was taken)
+        dist2 = None
+        if len(self.agents) == len(self.world.agents):
+            geometry = self.world.geometry
+            if np.array_equal(geometry.p_pos[:len(p_pos)], p_pos):
+                dist2 = geometry.dist2
+        return p_pos, dist2
+
+    # (start, end, neighbors, columns) of the predator and prey agents that are present,
+    # columns being the adjacency column of each agent of the species. Built once per
+    # pair of neighbour counts, agents are not created or destroyed at runtime
+    def _get_species(self, n_pred, n_prey):
+        species = self._species.get((n_pred, n_prey))
+        if species is None:
+            num_adversaries = self.world.num_adversaries
+            species = self._species[n_pred, n_prey] = [
+                (start, end, neighbors, np.array([agent.id for agent in self.agents[start:end]]) - start)
+                for start, end, neighbors in [(0, num_adversaries, n_pred), (num_adversaries, self.n, n_prey)]
+                if end > start]
+        return species
+
+    # one-hot adjacency (..., n_species, neighbors, n_species) of every species from the
+    # agent positions (..., n, dim_p): the nearest agents of the same species (itself
+    # first) that are within observe_field, zero rows for the missing ones. out can
+    # give the arrays to write them into
+    def _get_species_adj(self, p_pos, n_pred, n_prey, dist2=None, out=None):
+        adj_s = []
+        for s, (start, end, neighbors, columns) in enumerate(self._get_species(n_pred, n_prey)):
+            if self.neighbor_skin is not None and p_pos.ndim == 2:
+                index = self._neighbor_index.get(start)
+                if index is None or index.radius != self.observe_field or index.skin != self.neighbor_skin:
+                    index = self._neighbor_index[start] = NeighborIndex(self.observe_field, self.neighbor_skin)
+                nearest = index.knn(p_pos[start:end], neighbors)
+            else:
+                nearest = knn_indices(p_pos[..., start:end, :], neighbors, self.observe_field,
+                                      None if dist2 is None else dist2[..., start:end, start:end])
+            adj_s.append(one_hot_neighbors(nearest, end - start, columns, None if out is None else out[s]))
+        return adj_s
+
 
     # get info used for benchmarking
     def _get_info(self, agent):
@@ -195,6 +301,110 @@ class MultiAgentEnv(gym.Env):
             return 0.0
         return self.reward_callback(agent, self.world)
 
+    # observations of all policy agents, from observation_all_callback if given: an
+    # (n_agents, obs_dim) array or a list of per-agent observations for all world.agents
+    def _get_obs_n(self):
+        if self.observation_all_callback is None:
+            return [self._get_obs(agent) for agent in self.agents]
+        obs = self.observation_all_callback(self.world)
+        return [obs[i] for i in self._agent_idx]
+
+    # rewards of all policy agents, from reward_all_callback if given: (n_agents,)
+    def _get_reward_n(self):
+        if self.reward_all_callback is None:
+            return [self._get_reward(agent) for agent in self.agents]
+        return list(np.asarray(self.reward_all_callback(self.world), dtype=float)[self._agent_idx])
+
+    # dones of all policy agents, from done_all_callback if given: (n_agents,)
+    def _get_done_n(self):
+        if self.done_all_callback is None:
+            return [self._get_done(agent) for agent in self.agents]
+        return list(np.asarray(self.done_all_callback(self.world), dtype=bool)[self._agent_idx])
+
+    # precompute where the physical and communication parts of every agent's flat action
+    # are (movement first, then communication) and the per-agent sensitivity
+    def _build_action_layout(self):
+        dim_p, dim_c = self.world.dim_p, self.world.dim_c
+        if self.discrete_action_input:
+            u_size, c_size = 1, 1
+        elif self.discrete_action_space:
+            u_size, c_size = dim_p * 2 + 1, dim_c
+        else:
+            u_size, c_size = dim_p, dim_c
+        movable = np.array([agent.movable for agent in self.agents], dtype=bool)
+        talking = np.array([not agent.silent for agent in self.agents], dtype=bool)
+        self._action_flags = (self.discrete_action_space, self.discrete_action_input)
+        self._action_u_size = u_size
+        self._action_movable = np.flatnonzero(movable)
+        self._action_talking = np.flatnonzero(talking)
+        self._action_c_cols = np.where(movable, u_size, 0)[self._action_talking, None] + np.arange(c_size)
+        # zero for immovable agents, their physical action stays zero
+        sensitivity = np.array([5.0 if agent.accel is None else agent.accel for agent in self.agents])
+        self._action_sensitivity = (sensitivity * movable)[:, None]
+        # movement of every discrete choice: 0 no-op, then -x, +x, -y, +y, ...
+        self._action_u_table = np.zeros((dim_p * 2 + 1, dim_p))
+        self._action_u_table[1 + 2 * np.arange(dim_p), np.arange(dim_p)] = -1.0
+        self._action_u_table[2 + 2 * np.arange(dim_p), np.arange(dim_p)] = +1.0
+
+    # flat actions (..., n, act_dim) from a list of per-agent actions (..., act_dim_i),
+    # shorter ones are zero padded. lead is the number of leading (world) dimensions
+    def _stack_actions(self, action_n, lead=0):
+        if isinstance(action_n, np.ndarray):
+            # one discrete choice per agent
+            return action_n if action_n.ndim > lead + 1 else action_n[..., None]
+        action_n = [np.asarray(action, dtype=float) for action in action_n]
+        action_n = [action.reshape(action.shape[:lead] + (-1,)) for action in action_n]
+        width = max([action.shape[-1] for action in action_n] + [self._action_u_size])
+        actions = np.zeros(action_n[0].shape[:lead] + (len(action_n), width))
+        for i, action in enumerate(action_n):
+            actions[..., i, :action.shape[-1]] = action
+        return actions
+
+    # batched _set_action: physical actions (..., n, dim_p) and the utterances of the
+    # talking agents (..., n_talking, dim_c) from flat actions (..., n, act_dim). With
+    # force_discrete_action the movement part of the movable agents' actions is replaced
+    # in place by the one-hot of its largest entry
+    def _decode_actions(self, actions):
+        if self._action_flags != (self.discrete_action_space, self.discrete_action_input):
+            self._build_action_layout()
+        u_action = actions[..., :self._action_u_size]
+        if self.discrete_action_input:
+            u = self._action_u_table[u_action[..., 0].astype(int)]
+        else:
+            if self.force_discrete_action:
+                u_action = np.eye(self._action_u_size)[np.argmax(u_action, axis=-1)]
+                movable = self._action_movable
+                actions[..., movable, :self._action_u_size] = u_action[..., movable, :]
+            if self.discrete_action_space:
+                u = u_action[..., 1::2] - u_action[..., 2::2]
+            else:
+                u = u_action
+        u = u * self._action_sensitivity
+        c = None
+        if len(self._action_talking) > 0:
+            c = actions[..., self._action_talking[:, None], self._action_c_cols]
+            if self.discrete_action_input:
+                c = np.eye(self.world.dim_c)[c[..., 0].astype(int)]
+        return u, c
+
+    # set the actions of all agents from a list of per-agent actions or an (n, act_dim) array.
+    # As in _set_action, a forced discrete action is written back into action_n (an array
+    # is decoded in place, a list gets the rows of the decoded copy)
+    def _set_actions(self, action_n):
+        actions = self._stack_actions(action_n)
+        u, c = self._decode_actions(actions)
+        if self.force_discrete_action and not self.discrete_action_input and actions is not action_n:
+            for i in self._action_movable:
+                action_n[i][:self._action_u_size] = actions[i, :self._action_u_size]
+        world = self.world
+        if world.array_mode and world._array_entities == world.entities:
+            world.p_action[self._agent_idx] = u
+        else:
+            for i, agent in enumerate(self.agents):
+                agent.action.u = u[i]
+        for row, i in enumerate(self._action_talking):
+            self.agents[i].action.c = c[row]
+
     # set env action for a particular agent
     def _set_action(self, action, agent, action_space, time=None):
         agent.action.u = np.zeros(self.world.dim_p)
@@ -319,10 +529,12 @@ class MultiAgentEnv(gym.Env):
                     self.viewers[i].geoms.pop()
 
             self.count_line_landmark = 0
+            dist = self.world.geometry.dist
+            n_agents = len(self.world.agents)
             # build new lines for render
             for a, agent in enumerate(self.world.agents):  # between agents and landmarks
                 for l, landmark in enumerate(self.world.landmarks):
-                    dis = np.sqrt(np.sum(np.square([agent.state.p_pos - landmark.state.p_pos])))
+                    dis = dist[a, n_agents + l]
                     if dis <= self.world.observing_range:
                         self.count_line_landmark += 1
                         temp = rendering.make_line(agent.state.p_pos, landmark.state.p_pos)
@@ -333,7 +545,7 @@ class MultiAgentEnv(gym.Env):
                 for o, other in enumerate(self.world.agents):
                     if other is agent:
                         continue
-                    dis = np.sqrt(np.sum(np.square([agent.state.p_pos - other.state.p_pos])))
+                    dis = dist[a, o]
                     if dis <= self.world.observing_range:
                         self.count_line_other += 1
                         temp = rendering.make_line(agent.state.p_pos, other.state.p_pos)
@@ -366,53 +578,343 @@ class MultiAgentEnv(gym.Env):
         return dx
 
 
-# vectorized wrapper for a batch of multi-agent environments
-# assumes all environments have the same observation and action space
+# vectorized environment over several copies of the same scenario world
+# physics runs once on the (n_worlds, n_entities, dim_p) arrays of a BatchedWorld;
+# observations and rewards come from the scenario's batched hooks (evaluated on the
+# stacked arrays, returning (n_worlds, n_agents, ...)) when given, and from the
+# per-agent callbacks of every copy otherwise. Copies that reach max_episode_len,
+# or where all agents are done, are reset automatically.
+class VectorMultiAgentEnv(MultiAgentEnv):
+    def __init__(self, worlds, reset_callback=None, reward_callback=None,
+                 observation_callback=None, info_callback=None,
+                 done_callback=None, reward_all_callback=None,
+                 observation_all_callback=None, done_all_callback=None, reset_all_callback=None,
+                 max_episode_len=None):
+        super(VectorMultiAgentEnv, self).__init__(worlds[0], reset_callback, reward_callback,
+                                                  observation_callback, info_callback, done_callback,
+                                                  reward_all_callback=reward_all_callback,
+                                                  observation_all_callback=observation_all_callback,
+                                                  done_all_callback=done_all_callback,
+                                                  reset_all_callback=reset_all_callback)
+        self.worlds = worlds
+        self.num_envs = len(worlds)
+        self.batched_world = BatchedWorld(worlds)
+        self.max_episode_len = max_episode_len
+        self.episode_step = np.zeros(self.num_envs, dtype=int)
+
+    def step(self, action_n):
+        self._set_actions(action_n)
+        self.batched_world.step()
+        self.episode_step += 1
+        obs_n = self._get_obs_all()
+        reward_n = self._get_reward_all()
+        done_n = self._get_done_all()
+        info_n = {'n': self._get_info_all()}
+        # all agents get total reward in cooperative case
+        if self.shared_reward:
+            reward_n[:] = np.sum(reward_n, axis=1, keepdims=True)
+        adj_n = self._get_adj_all()
+
+        # reset finished copies, their last observations are kept in info_n
+        terminal = np.all(done_n, axis=1)
+        if self.max_episode_len is not None:
+            terminal |= self.episode_step >= self.max_episode_len
+        info_n['terminal'] = terminal
+        if np.any(terminal):
+            info_n['terminal_obs_n'] = obs_n
+            info_n['terminal_adj_n'] = adj_n
+            self._reset_worlds([self.worlds[k] for k in np.flatnonzero(terminal)])
+            self.batched_world.invalidate_geometry()
+            self.episode_step[terminal] = 0
+            obs_n = self._get_obs_all()
+            adj_n = self._get_adj_all()
+        return obs_n, reward_n, done_n, info_n, adj_n
+
+    def reset(self):
+        self._reset_worlds(self.worlds)
+        self.batched_world.invalidate_geometry()
+        self.episode_step[:] = 0
+        self._reset_render()
+        return self._get_obs_all(), self._get_adj_all()
+
+    # step_arrays of all copies: actions is one (n_worlds, n, act_dim) array and the
+    # observations (n_worlds, n, obs_dim), rewards and dones (n_worlds, n) and adjacency
+    # (n_worlds, n, k, m) are written into reused float32 buffers, zero padded as in
+    # MultiAgentEnv.step_arrays. Finished copies are reset as in step(): info_n['terminal']
+    # marks them and 'terminal_obs' / 'terminal_adj' hold copies of their last rows
+    def step_arrays(self, actions):
+        self._set_actions(actions)
+        self.batched_world.step()
+        self.episode_step += 1
+        if self._obs_buf is None:
+            self._build_array_buffers((self.num_envs,))
+        self._write_obs(self._obs_buf)
+        self._write_reward(self._rew_buf)
+        self._write_done(self._done_buf)
+        self._write_adj()
+        info_n = {'n': self._get_info_all()}
+
+        terminal = np.all(self._done_buf > 0, axis=1)
+        if self.max_episode_len is not None:
+            terminal |= self.episode_step >= self.max_episode_len
+        info_n['terminal'] = terminal
+        if np.any(terminal):
+            info_n['terminal_obs'] = self._obs_buf[terminal]
+            info_n['terminal_adj'] = self._adj_buf[terminal]
+            self._reset_worlds([self.worlds[k] for k in np.flatnonzero(terminal)])
+            self.batched_world.invalidate_geometry()
+            self.episode_step[terminal] = 0
+            self._write_obs(self._obs_buf)
+            self._write_adj()
+        return self._obs_buf, self._rew_buf, self._done_buf, info_n, self._adj_buf
+
+    # reset() counterpart of step_arrays, returns the reused observation and adjacency buffers
+    def reset_arrays(self):
+        self._reset_worlds(self.worlds)
+        self.batched_world.invalidate_geometry()
+        self.episode_step[:] = 0
+        self._reset_render()
+        if self._obs_buf is None:
+            self._build_array_buffers((self.num_envs,))
+        self._write_obs(self._obs_buf)
+        self._write_adj()
+        return self._obs_buf, self._adj_buf
+
+    def _write_obs(self, out):
+        for row, obs in enumerate(self._get_obs_all()):
+            out[:, row, :obs.shape[-1]] = obs
+
+    def _write_reward(self, out):
+        reward = self._get_reward_all()
+        # all agents get total reward in cooperative case
+        out[:] = np.sum(reward, axis=1, keepdims=True) if self.shared_reward else reward
+
+    def _write_done(self, out):
+        out[:] = self._get_done_all()
+
+    # positions (n_worlds, n, dim_p) of the policy agents in every copy, and their squared
+    # distances when no agents are scripted
+    def _get_agent_pos(self):
+        p_pos = self.batched_world.p_pos[:, self._agent_idx]
+        dist2 = self.batched_world.geometry.dist2 if len(self.agents) == len(self.world.agents) else None
+        return p_pos, dist2
+
+    # observations as a list of (n_worlds, obs_dim) arrays, one per agent
+    def _get_obs_all(self):
+        if self.observation_all_callback is not None:
+            obs = self.observation_all_callback(self.batched_world)
+            if isinstance(obs, np.ndarray):
+                return [obs[:, i] for i in self._agent_idx]
+            return [obs[i] for i in self._agent_idx]
+        if self.observation_callback is None:
+            return [np.zeros((self.num_envs, 0)) for _ in self._agent_idx]
+        return [np.array([self.observation_callback(world.agents[i], world) for world in self.worlds])
+                for i in self._agent_idx]
+
+    # rewards as an (n_worlds, n_agents) array
+    def _get_reward_all(self):
+        if self.reward_all_callback is not None:
+            return np.array(self.reward_all_callback(self.batched_world)[:, self._agent_idx], dtype=float)
+        if self.reward_callback is None:
+            return np.zeros((self.num_envs, self.n))
+        return np.array([[self.reward_callback(world.agents[i], world) for i in self._agent_idx]
+                         for world in self.worlds], dtype=float)
+
+    # dones as an (n_worlds, n_agents) array
+    def _get_done_all(self):
+        if self.done_all_callback is not None:
+            return np.array(self.done_all_callback(self.batched_world)[:, self._agent_idx], dtype=bool)
+        if self.done_callback is None:
+            return np.zeros((self.num_envs, self.n), dtype=bool)
+        return np.array([[self.done_callback(world.agents[i], world) for i in self._agent_idx]
+                         for world in self.worlds], dtype=bool)
+
+    def _get_info_all(self):
+        if self.info_callback is None:
+            return []
+        return [[self.info_callback(world.agents[i], world) for i in self._agent_idx] for world in self.worlds]
+
+    # adjacency as a list of (n_worlds, neighbors, species size) arrays, one per agent
+    def _get_adj_all(self):
+        p_pos, dist2 = self._get_agent_pos()
+        adj_n = []
+        for adj in self._get_species_adj(p_pos, self.world.neighbors_pred, self.world.neighbors_prey, dist2):
+            adj_n.extend([adj[:, i] for i in range(adj.shape[1])])
+        return adj_n
+
+    # actions as an (n_worlds, n_agents, act_dim) array or a list of (n_worlds, act_dim) arrays
+    def _set_actions(self, action_n):
+        u, c = self._decode_actions(self._stack_actions(action_n, lead=1))
+        self.batched_world.p_action[:, self._agent_idx] = u
+        for row, i in enumerate(self._action_talking):
+            for k, world in enumerate(self.worlds):
+                world.agents[self._agent_idx[i]].action.c = c[k, row]
+
+
+# numpy view of a buffer in shared memory
+def _shared_view(raw, shape, dtype):
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+# flat size of an action from the given action space
+def _action_dim(action_space):
+    if isinstance(action_space, spaces.Discrete):
+        return action_space.n
+    if isinstance(action_space, MultiDiscrete):
+        return int(np.sum(action_space.high - action_space.low + 1))
+    if isinstance(action_space, spaces.Tuple):
+        return sum([_action_dim(space) for space in action_space.spaces])
+    return int(np.prod(action_space.shape))
+
+
+# subprocess loop of BatchMultiAgentEnv: actions are read from and results written
+# to the shared buffers, the pipe only carries commands and (optional) infos
+def _batch_env_worker(remote, parent_remote, env_fn, buffers, index, max_episode_len, seed):
+    parent_remote.close()
+    np.random.seed(seed)
+    env = env_fn()
+    views = dict((name, _shared_view(*spec)) for name, spec in buffers.items())
+
+    def write(prefix, obs_n, adj_n):
+        for i in range(env.n):
+            views[prefix + 'obs%d' % i][index] = obs_n[i]
+            views[prefix + 'adj%d' % i][index] = adj_n[i]
+
+    episode_step = 0
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                action_n = [np.array(views['act%d' % i][index]) for i in range(env.n)]
+                obs_n, reward_n, done_n, info_n, adj_n = env.step(action_n)
+                episode_step += 1
+                terminal = all(done_n) or (max_episode_len is not None and episode_step >= max_episode_len)
+                views['rew'][index] = reward_n
+                views['done'][index] = done_n
+                views['terminal'][index] = terminal
+                if terminal:
+                    write('terminal_', obs_n, adj_n)
+                    obs_n, adj_n = env.reset()
+                    episode_step = 0
+                write('', obs_n, adj_n)
+                remote.send(info_n['n'] if env.info_callback is not None else None)
+            elif cmd == 'reset':
+                obs_n, adj_n = env.reset()
+                episode_step = 0
+                write('', obs_n, adj_n)
+                remote.send(None)
+            elif cmd == 'render':
+                remote.send(env.render(data))
+            elif cmd == 'close':
+                break
+            else:
+                raise NotImplementedError(cmd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        remote.close()
+
+
+# vectorized wrapper running a batch of multi-agent environments in worker processes
+# env_fns create the environments (they must be picklable unless processes are forked);
+# all environments must have the same observation and action spaces. Results are
+# stacked along a leading (num_envs,) dimension in shared memory, workers reset their
+# environment when all agents are done or after max_episode_len steps.
 class BatchMultiAgentEnv(gym.Env):
     metadata = {
         'runtime.vectorized': True,
         'render.modes' : ['human', 'rgb_array']
     }
 
-    def __init__(self, env_batch):
-        self.env_batch = env_batch
-
-    @property
-    def n(self):
-        return np.sum([env.n for env in self.env_batch])
-
-    @property
-    def action_space(self):
-        return self.env_batch[0].action_space
+    def __init__(self, env_fns, max_episode_len=None, seed=0):
+        import multiprocessing as mp
+        self.num_envs = len(env_fns)
+        # spaces and buffer shapes come from a local copy of the environment
+        env = env_fns[0]()
+        self.n = env.n
+        # world of the local copy, for the properties all copies share (neighbour counts, ...)
+        self.world = env.world
+        self.action_space = env.action_space
+        self.observation_space = env.observation_space
+        obs_n, adj_n = env.reset()
+        shapes = {'rew': ((self.n,), np.float64), 'done': ((self.n,), np.bool_), 'terminal': ((), np.bool_)}
+        for i in range(self.n):
+            for prefix in ['', 'terminal_']:
+                shapes[prefix + 'obs%d' % i] = (np.shape(obs_n[i]), np.float64)
+                shapes[prefix + 'adj%d' % i] = (np.shape(adj_n[i]), np.float64)
+            shapes['act%d' % i] = ((_action_dim(self.action_space[i]),), np.float64)
+        buffers = {}
+        for name, (shape, dtype) in shapes.items():
+            shape = (self.num_envs,) + shape
+            raw = mp.RawArray('b', int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            buffers[name] = (raw, shape, dtype)
+        self._views = dict((name, _shared_view(*spec)) for name, spec in buffers.items())
+
+        self.remotes, self.work_remotes = zip(*[mp.Pipe() for _ in range(self.num_envs)])
+        self.processes = [mp.Process(target=_batch_env_worker,
+                                     args=(work_remote, remote, env_fn, buffers, index, max_episode_len, seed + index))
+                          for index, (work_remote, remote, env_fn) in enumerate(zip(self.work_remotes, self.remotes, env_fns))]
+        for process in self.processes:
+            process.daemon = True  # if the main process crashes, we should not cause things to hang
+            process.start()
+        for remote in self.work_remotes:
+            remote.close()
+        self.waiting = False
+        self.closed = False
+
+    # actions as a list of (num_envs, act_dim) arrays, one per agent, or (num_envs, n, act_dim)
+    def step_async(self, action_n):
+        for i in range(self.n):
+            self._views['act%d' % i][...] = action_n[:, i] if isinstance(action_n, np.ndarray) else action_n[i]
+        for remote in self.remotes:
+            remote.send(('step', None))
+        self.waiting = True
+
+    def step_wait(self):
+        infos = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        terminal = self._views['terminal'].copy()
+        info_n = {'n': infos if infos[0] is not None else [], 'terminal': terminal}
+        if np.any(terminal):
+            info_n['terminal_obs_n'] = [self._views['terminal_obs%d' % i].copy() for i in range(self.n)]
+            info_n['terminal_adj_n'] = [self._views['terminal_adj%d' % i].copy() for i in range(self.n)]
+        obs_n, adj_n = self._get_obs_adj()
+        return obs_n, self._views['rew'].copy(), self._views['done'].copy(), info_n, adj_n
 
-    @property
-    def observation_space(self):
-        return self.env_batch[0].observation_space
-
-    def step(self, action_n, time):
-        obs_n = []
-        reward_n = []
-        done_n = []
-        info_n = {'n': []}
-        i = 0
-        for env in self.env_batch:
-            obs, reward, done, _ = env.step(action_n[i:(i+env.n)], time)
-            i += env.n
-            obs_n += obs
-            # reward = [r / len(self.env_batch) for r in reward]
-            reward_n += reward
-            done_n += done
-        return obs_n, reward_n, done_n, info_n
+    def step(self, action_n):
+        self.step_async(action_n)
+        return self.step_wait()
 
     def reset(self):
-        obs_n = []
-        for env in self.env_batch:
-            obs_n += env.reset()
-        return obs_n
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        for remote in self.remotes:
+            remote.recv()
+        return self._get_obs_adj()
+
+    # stacked observations and adjacency, one (num_envs, ...) array per agent
+    def _get_obs_adj(self):
+        obs_n = [self._views['obs%d' % i].copy() for i in range(self.n)]
+        adj_n = [self._views['adj%d' % i].copy() for i in range(self.n)]
+        return obs_n, adj_n
+
+    def close(self):
+        if self.closed:
+            return
+        if self.waiting:
+            for remote in self.remotes:
+                remote.recv()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
 
     # render environment
-    def render(self, mode='human', close=True):
+    def render(self, mode='human'):
+        for remote in self.remotes:
+            remote.send(('render', mode))
         results_n = []
-        for env in self.env_batch:
-            results_n += env.render(mode, close)
+        for remote in self.remotes:
+            results_n += remote.recv()
         return results_n
@@ -4,7 +4,11 @@
 import numpy as np
 
 import gym
-from gym.spaces import prng
+try:
+    from gym.spaces import prng
+except ImportError:
+    # gym.spaces.prng is gone from later Gym releases, sample from numpy's global generator
+    prng = None
 
 class MultiDiscrete(gym.Space):
     """
@@ -30,7 +34,7 @@ class MultiDiscrete(gym.Space):
     def sample(self):
         """ Returns a array with one sample from each discrete action space """
         # For each row: round(random .* (max - min) + min, 0)
-        random_array = prng.np_random.rand(self.num_discrete_space)
+        random_array = (np.random if prng is None else prng.np_random).rand(self.num_discrete_space)
         return [int(x) for x in np.floor(np.multiply((self.high - self.low + 1.), random_array) + self.low)]
     def contains(self, x):
         return len(x) == self.num_discrete_space and (np.array(x) >= self.low).all() and (np.array(x) <= self.high).all()
@@ -0,0 +1,52 @@
+import numpy as np
+
+# loop-based versions of vectorized code, kept as the reference that the tests and
+# experiments/benchmark_speed.py compare the batched kernels against
+
+
+# per-agent simple_spread reward and observation as they were before vectorizing,
+# the reference for reward_all / observation_all
+def reference_spread_reward(scenario, agent, world):
+    rew = 0
+    for l in world.landmarks:
+        dists = [np.sqrt(np.sum(np.square(a.state.p_pos - l.state.p_pos))) for a in world.agents]
+        rew -= min(dists)
+    if agent.collide:
+        for a in world.agents:
+            if scenario.is_collision(a, agent):
+                rew -= 1
+    return rew
+
+
+def reference_spread_observation(agent, world):
+    def nearest_visible(others, m):
+        pos_temp = []
+        for other in others:
+            distance = np.sqrt(np.sum(np.square([other.state.p_pos - agent.state.p_pos])))
+            if distance < world.observing_range:
+                pos_temp.append([other.state.p_pos - agent.state.p_pos, distance])
+        pos_temp.sort(key=lambda pos: pos[1])
+        pos = [p for p, _ in pos_temp[0:m]]
+        for i in range(len(pos), m):
+            pos.append([-1, -1])
+        return pos
+    entity_pos = nearest_visible(world.landmarks, np.min([3, len(world.landmarks)]))
+    other_pos = nearest_visible([other for other in world.agents if other is not agent],
+                                np.min([3, len(world.agents) - 1]))
+    return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos)
+
+
+# one-hot adjacency (n, k, num_classes) of points (n, dim), one point at a time as
+# MultiAgentEnv._get_adj built it: the first k of the stable argsort of the squared
+# distances (the point itself first), zero rows for those not within radius and
+# for k beyond n. columns maps a point index to its adjacency column; the reference
+# for one_hot_neighbors(knn_indices(...)) and NeighborIndex.knn
+def reference_adjacency(points, k, radius, num_classes=None, columns=None):
+    n = len(points)
+    adj = np.zeros((n, k, n if num_classes is None else num_classes))
+    for i in range(n):
+        dist2 = np.sum(np.square(points - points[i]), axis=-1)
+        for row, j in enumerate(np.argsort(dist2, kind='stable')[:k]):
+            if dist2[j] < radius * radius:
+                adj[i, row, j if columns is None else columns[j]] = 1.0
+    return adj
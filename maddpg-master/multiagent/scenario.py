@@ -2,9 +2,37 @@ import numpy as np
 
 # defines scenario upon which the world is built
 class BaseScenario(object):
+    # size parameters (numbers of agents, landmarks, ...) the scenario accepts, with their
+    # default values, and named presets that override some of them
+    defaults = {}
+    presets = {}
+    # the parameters of the world to build: defaults, updated by the preset and then by
+    # the keyword arguments
+    def __init__(self, preset=None, **params):
+        unknown = sorted(set(params) - set(self.defaults))
+        if len(unknown) > 0:
+            raise TypeError('{} does not take the parameters {}, only {}'.format(
+                type(self).__module__, unknown, sorted(self.defaults)))
+        if preset is not None and preset not in self.presets:
+            raise ValueError('unknown preset {}, choose from {}'.format(preset, sorted(self.presets)))
+        self.params = dict(self.defaults)
+        if preset is not None:
+            self.params.update(self.presets[preset])
+        self.params.update(params)
     # create elements of the world
     def make_world(self):
         raise NotImplementedError()
     # create initial conditions of the world
     def reset_world(self, world):
         raise NotImplementedError()
+    # whole-world versions of the per-agent callbacks that the scenario implements
+    # (reward_all, observation_all, done_all), as keyword arguments for the environment.
+    # They take the world and return rewards (..., n_agents), observations (..., n_agents,
+    # obs_dim) or a list of per-agent observations, and dones (..., n_agents). reset_all
+    # resets a list of worlds at once
+    def batch_callbacks(self):
+        callbacks = {}
+        for name in ['reward_all', 'observation_all', 'done_all', 'reset_all']:
+            if hasattr(self, name):
+                callbacks[name + '_callback'] = getattr(self, name)
+        return callbacks
@@ -1,7 +1,50 @@
-import imp
+import importlib
 import os.path as osp
+from glob import glob
 
+# scenario modules imported so far, by scenario name
+_registry = {}
 
+
+# names of the scenario scripts in this package, e.g. 'simple_spread'
+def names():
+    return sorted(osp.splitext(osp.basename(path))[0] for path in glob(osp.join(osp.dirname(__file__), '*.py'))
+                  if osp.basename(path) != '__init__.py')
+
+
+# scenario module of the given name ('simple_spread' or 'simple_spread.py'), imported
+# once as multiagent.scenarios.<name> and cached
 def load(name):
-    pathname = osp.join(osp.dirname(__file__), name)
-    return imp.load_source('', pathname)
+    name = osp.splitext(osp.basename(name))[0]
+    if name not in _registry:
+        if name not in names():
+            raise ValueError('unknown scenario {}, available: {}'.format(name, ', '.join(names())))
+        _registry[name] = importlib.import_module(__name__ + '.' + name)
+    return _registry[name]
+
+
+# scenario of the given script, built with the given preset and size parameters
+def make(name, preset=None, **params):
+    return load(name).Scenario(preset=preset, **params)
+
+
+# multi-agent environment of the given scenario. The scenario module is only imported
+# once per process, so functools.partial(make_env, name, ...) is a cheap, picklable
+# env_fn for BatchMultiAgentEnv workers
+def make_env(name, preset=None, benchmark=False, **params):
+    from multiagent.environment import MultiAgentEnv
+    scenario = make(name, preset, **params)
+    world = scenario.make_world()
+    return MultiAgentEnv(world, scenario.reset_world, scenario.reward, scenario.observation,
+                         scenario.benchmark_data if benchmark else None, **scenario.batch_callbacks())
+
+
+# VectorMultiAgentEnv over num_envs copies of the world of the given scenario, stepped
+# together on batched arrays; copies are reset after max_episode_len steps
+def make_vector_env(name, num_envs, preset=None, max_episode_len=None, benchmark=False, **params):
+    from multiagent.environment import VectorMultiAgentEnv
+    scenario = make(name, preset, **params)
+    worlds = [scenario.make_world() for _ in range(num_envs)]
+    return VectorMultiAgentEnv(worlds, scenario.reset_world, scenario.reward, scenario.observation,
+                               scenario.benchmark_data if benchmark else None,
+                               max_episode_len=max_episode_len, **scenario.batch_callbacks())
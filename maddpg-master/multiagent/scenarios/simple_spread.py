@@ -1,22 +1,36 @@
 import numpy as np
 from multiagent.core import World, Agent, Landmark
 from multiagent.scenario import BaseScenario
+from multiagent.spatial import smallest_k, place_discs
 
 
 class Scenario(BaseScenario):
+    # arena is the half width of the area the entities start in, None grows it with the
+    # number of agents (same density as the default 5 agents in [-1, 1])
+    defaults = dict(num_agents=5, num_landmarks=5, neighbors=2, observing_range=0.7, arena=1.0, array_mode=False)
+    presets = {
+        # 100-1000 agents: array-backed physics, grid broad phase and Verlet neighbour lists
+        'large': dict(num_agents=200, num_landmarks=200, neighbors=4, arena=None, array_mode=True),
+    }
+
     def make_world(self):
         world = World()
         # set any world properties first
         world.dim_c = 2
-        num_agents = 5
-        num_landmarks = 5
-        observing_range = 0.7
+        num_agents = self.params['num_agents']
+        num_landmarks = self.params['num_landmarks']
+        observing_range = self.params['observing_range']
         world.observing_range = observing_range
         world.num_adversaries = num_agents
         world.collaborative = False
-        world.neighbors_pred = 2
-        world.neighbors_prey = 2
+        world.neighbors_pred = self.params['neighbors']
+        world.neighbors_prey = self.params['neighbors']
         world.min_corridor = 0.06
+        world.arena = self.params['arena'] if self.params['arena'] is not None else np.sqrt(num_agents / 5.0)
+        if self.params['array_mode']:
+            world.array_mode = True
+            world.collision_broadphase = 'grid'
+            world.neighbor_skin = 0.3
         # add agents
         world.agents = [Agent() for i in range(num_agents)]
         for i, agent in enumerate(world.agents):
@@ -36,51 +50,41 @@ class Scenario(BaseScenario):
         return world
 
     def reset_world(self, world):
-        # random properties for agents
-        for i, agent in enumerate(world.agents):
-            agent.color = np.array([0.35, 0.35, 0.85])
-        # random properties for landmarks
-        for i, landmark in enumerate(world.landmarks):
-            landmark.color = np.array([0.25, 0.25, 0.25])
-        # set random initial states
-        for agent in world.agents:
-            agent.state.p_pos = np.random.uniform(-1, +1, world.dim_p)
-            agent.state.p_vel = np.zeros(world.dim_p)
-            agent.state.c = np.zeros(world.dim_c)
-        for i, landmark in enumerate(world.landmarks):
-            '''landmark.state.p_pos = np.random.uniform(-1, +1, world.dim_p)
-            landmark.state.p_vel = np.zeros(world.dim_p)'''
-            flag = 1
-            while flag:
-                landmark.state.p_pos = np.random.uniform(-1, +1, world.dim_p)
-                if i == 0:
-                    break
-                temp1 = []
-                temp2 = []
-                for j in range(0, i):
-                    temp1.append(np.sqrt(np.sum(np.square(world.landmarks[j].state.p_pos - landmark.state.p_pos))))
-                    temp2.append(world.landmarks[j].size + landmark.size + world.min_corridor)
-                if min(np.array(temp1) - np.array(temp2)) > 0 :
-                    flag = 0
-            landmark.state.p_vel = np.zeros(world.dim_p)
+        self.reset_all([world])
+
+    # reset several copies of the world at once, the landmarks of all copies are placed together
+    def reset_all(self, worlds):
+        for world in worlds:
+            # random properties for agents
+            for i, agent in enumerate(world.agents):
+                agent.color = np.array([0.35, 0.35, 0.85])
+            # random properties for landmarks
+            for i, landmark in enumerate(world.landmarks):
+                landmark.color = np.array([0.25, 0.25, 0.25])
+            # set random initial states
+            for agent in world.agents:
+                agent.state.p_pos = np.random.uniform(-world.arena, +world.arena, world.dim_p)
+                agent.state.p_vel = np.zeros(world.dim_p)
+                agent.state.c = np.zeros(world.dim_c)
+        # landmarks keep a corridor of min_corridor between them
+        template = worlds[0]
+        landmark_pos = place_discs([landmark.size for landmark in template.landmarks], template.min_corridor,
+                                   -template.arena, +template.arena, template.dim_p, (len(worlds),))
+        for k, world in enumerate(worlds):
+            for i, landmark in enumerate(world.landmarks):
+                landmark.state.p_pos = landmark_pos[k, i]
+                landmark.state.p_vel = np.zeros(world.dim_p)
 
     def benchmark_data(self, agent, world):
-        rew = 0
+        geometry = world.geometry
+        min_dists = np.min(geometry.agent_landmark_dist, axis=0)
+        rew = self.coverage_reward(geometry)
+        occupied_landmarks = np.sum(min_dists < 0.1)
         collisions = 0
-        occupied_landmarks = 0
-        min_dists = 0
-        for l in world.landmarks:
-            dists = [np.sqrt(np.sum(np.square(a.state.p_pos - l.state.p_pos))) for a in world.agents]
-            min_dists += min(dists)
-            rew -= min(dists)
-            if min(dists) < 0.1:
-                occupied_landmarks += 1
         if agent.collide:
-            for a in world.agents:
-                if self.is_collision(a, agent):
-                    rew -= 1
-                    collisions += 1
-        return (rew, collisions, min_dists, occupied_landmarks)
+            collisions = np.sum(geometry.overlap[geometry.index(agent), :geometry.n_agents])
+            rew -= collisions
+        return (rew, collisions, np.sum(min_dists), occupied_landmarks)
 
 
     def is_collision(self, agent1, agent2):
@@ -89,69 +93,56 @@ class Scenario(BaseScenario):
         dist_min = agent1.size + agent2.size
         return True if dist < dist_min else False
 
+    # negative sum over landmarks of the distance to the closest agent, shared by all agents
+    def coverage_reward(self, geometry):
+        if 'coverage' not in geometry.cache:
+            geometry.cache['coverage'] = -np.sum(np.min(geometry.agent_landmark_dist, axis=-2), axis=-1)
+        return geometry.cache['coverage']
+
     def reward(self, agent, world):
         # Agents are rewarded based on minimum agent distance to each landmark, penalized for collisions
-        rew = 0
-        for l in world.landmarks:
-            dists = [np.sqrt(np.sum(np.square(a.state.p_pos - l.state.p_pos))) for a in world.agents]
-            rew -= min(dists)
+        geometry = world.geometry
+        rew = self.coverage_reward(geometry)
         if agent.collide:
-            for a in world.agents:
-                '''if a is agent:
-                    continue'''
-                if self.is_collision(a, agent):
-                    rew -= 1
+            # collisions are counted against every agent, itself included
+            rew -= np.sum(geometry.overlap[geometry.index(agent), :geometry.n_agents])
         return rew
 
     def observation(self, agent, world):
-        # get positions of all entities in this agent's reference frame
-        entity_pos_temp = []
-        min_observable_landmark = np.min([3, len(world.landmarks)])
-        for entity in world.landmarks:  # world.entities:
-            distance = np.sqrt(np.sum(np.square([entity.state.p_pos - agent.state.p_pos])))
-            if distance < world.observing_range:
-                entity_pos_temp.append([entity.state.p_pos - agent.state.p_pos, distance])
-        entity_pos_temp.sort(key=lambda pos: pos[1])
-        entity_pos_temp = entity_pos_temp[0:min_observable_landmark]
-        entity_pos = [entity_pos_temp[i][0] for i in range(len(entity_pos_temp))]
-        for i in range(len(entity_pos_temp), min_observable_landmark):
-            entity_pos.append([-1, -1])
-
-        '''entity_pos_temp = []
-        min_observable_landmark = len(world.landmarks)
-        for entity in world.landmarks:  # world.entities:
-            entity_pos_temp.append(entity.state.p_pos - agent.state.p_pos)
-        entity_pos_temp = entity_pos_temp[0:min_observable_landmark]
-        entity_pos = entity_pos_temp
-        for i in range(len(entity_pos_temp), min_observable_landmark):
-            entity_pos.append([-1, -1])'''
+        return self.observe(world, np.array([world.geometry.index(agent)]))[0]
 
-        # entity colors
-        entity_color = []
-        for entity in world.landmarks:  # world.entities:
-            entity_color.append(entity.color)
+    # batched reward for all agents: (..., n_agents)
+    def reward_all(self, world):
+        geometry = world.geometry
+        n = geometry.n_agents
+        collide = np.array([agent.collide for agent in world.agents])
+        collisions = np.sum(geometry.overlap[..., :n, :n], axis=-1)
+        return self.coverage_reward(geometry)[..., None] - collisions * collide
 
-        # communication of all other agents
-        comm = []
-        # other_pos = []
-        for other in world.agents:
-            if other is agent:
-                continue
-            comm.append(other.state.c)
-            # other_pos.append(other.state.p_pos - agent.state.p_pos)
+    # batched observation for all agents: (..., n_agents, obs_dim)
+    def observation_all(self, world):
+        return self.observe(world, np.arange(len(world.agents)))
 
-        other_pos_temp = []
-        min_observable_other = np.min([3, len(world.agents) - 1])
-        for other in world.agents:  # world.entities:
-            if other is agent:
-                continue
-            distance = np.sqrt(np.sum(np.square([other.state.p_pos - agent.state.p_pos])))
-            if distance < world.observing_range:
-                other_pos_temp.append([other.state.p_pos - agent.state.p_pos, distance])
-        other_pos_temp.sort(key=lambda pos: pos[1])
-        other_pos_temp = other_pos_temp[0:min_observable_other]
-        other_pos = [other_pos_temp[i][0] for i in range(len(other_pos_temp))]
-        for i in range(len(other_pos_temp), min_observable_other):
-            other_pos.append([-1, -1])
+    # observations (..., len(rows), obs_dim) of the agents in rows: velocity, position and
+    # the relative positions of the nearest 3 landmarks and other agents within range
+    def observe(self, world, rows):
+        geometry = world.geometry
+        n = geometry.n_agents
+        delta = geometry.delta[..., rows, :, :]
+        dist = geometry.dist[..., rows, :]
+        visible = dist < world.observing_range
+        entity_pos = self.nearest_visible(delta[..., n:, :], dist[..., n:], visible[..., n:],
+                                          min(3, len(world.landmarks)))
+        # an agent does not observe itself
+        visible[..., np.arange(len(rows)), rows] = False
+        other_pos = self.nearest_visible(delta[..., :n, :], dist[..., :n], visible[..., :n], min(3, n - 1))
+        return np.concatenate([geometry.p_vel[..., rows, :], geometry.p_pos[..., rows, :], entity_pos, other_pos],
+                              axis=-1)
 
-        return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos)
+    # the m nearest visible of the relative positions (..., rows, targets, dim_p), nearest
+    # first and flattened to (..., rows, m * dim_p), padded with -1
+    def nearest_visible(self, rel_pos, dist, visible, m):
+        order = smallest_k(np.where(visible, dist, np.inf), m)
+        rel_pos = np.take_along_axis(rel_pos, order[..., None], axis=-2)
+        rel_pos[~np.take_along_axis(visible, order, axis=-1)] = -1
+        return rel_pos.reshape(rel_pos.shape[:-2] + (-1,))
@@ -4,18 +4,20 @@ from multiagent.scenario import BaseScenario
 
 
 class Scenario(BaseScenario):
+    defaults = dict(num_agents=3, num_landmarks=3, neighbors=2, observing_range=0.7)
+
     def make_world(self):
         world = World()
         # set any world properties first
         world.dim_c = 2
-        num_agents = 3
-        num_landmarks = 3
-        observing_range = 0.7
+        num_agents = self.params['num_agents']
+        num_landmarks = self.params['num_landmarks']
+        observing_range = self.params['observing_range']
         world.observing_range = observing_range
         world.num_adversaries = num_agents
         world.collaborative = True
-        world.neighbors_pred = 2
-        world.neighbors_prey = 2
+        world.neighbors_pred = self.params['neighbors']
+        world.neighbors_prey = self.params['neighbors']
         # add agents
         world.agents = [Agent() for i in range(num_agents)]
         for i, agent in enumerate(world.agents):
@@ -51,22 +53,15 @@ class Scenario(BaseScenario):
             landmark.state.p_vel = np.zeros(world.dim_p)
 
     def benchmark_data(self, agent, world):
-        rew = 0
+        geometry = world.geometry
+        min_dists = np.min(geometry.agent_landmark_dist, axis=0)
+        rew = self.coverage_reward(geometry)
+        occupied_landmarks = np.sum(min_dists < 0.1)
         collisions = 0
-        occupied_landmarks = 0
-        min_dists = 0
-        for l in world.landmarks:
-            dists = [np.sqrt(np.sum(np.square(a.state.p_pos - l.state.p_pos))) for a in world.agents]
-            min_dists += min(dists)
-            rew -= min(dists)
-            if min(dists) < 0.1:
-                occupied_landmarks += 1
         if agent.collide:
-            for a in world.agents:
-                if self.is_collision(a, agent):
-                    rew -= 1
-                    collisions += 1
-        return (rew, collisions, min_dists, occupied_landmarks)
+            collisions = np.sum(geometry.overlap[geometry.index(agent), :geometry.n_agents])
+            rew -= collisions
+        return (rew, collisions, np.sum(min_dists), occupied_landmarks)
 
 
     def is_collision(self, agent1, agent2):
@@ -75,16 +70,18 @@ class Scenario(BaseScenario):
         dist_min = agent1.size + agent2.size
         return True if dist < dist_min else False
 
+    # negative sum over landmarks of the distance to the closest agent, shared by all agents
+    def coverage_reward(self, geometry):
+        if 'coverage' not in geometry.cache:
+            geometry.cache['coverage'] = -np.sum(np.min(geometry.agent_landmark_dist, axis=-2), axis=-1)
+        return geometry.cache['coverage']
+
     def reward(self, agent, world):
         # Agents are rewarded based on minimum agent distance to each landmark, penalized for collisions
-        rew = 0
-        for l in world.landmarks:
-            dists = [np.sqrt(np.sum(np.square(a.state.p_pos - l.state.p_pos))) for a in world.agents]
-            rew -= min(dists)
+        geometry = world.geometry
+        rew = self.coverage_reward(geometry)
         if agent.collide:
-            for a in world.agents:
-                if self.is_collision(a, agent):
-                    rew -= 1
+            rew -= np.sum(geometry.overlap[geometry.index(agent), :geometry.n_agents])
         return rew
 
     def observation(self, agent, world):
@@ -104,3 +101,25 @@ class Scenario(BaseScenario):
             comm.append(other.state.c)
             other_pos.append(other.state.p_pos - agent.state.p_pos)
         return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + comm)
+
+    # batched reward for all agents: (..., n_agents)
+    def reward_all(self, world):
+        geometry = world.geometry
+        n = geometry.n_agents
+        collide = np.array([agent.collide for agent in world.agents])
+        collisions = np.sum(geometry.overlap[..., :n, :n], axis=-1)
+        return self.coverage_reward(geometry)[..., None] - collisions * collide
+
+    # batched observation for all agents: (..., n_agents, obs_dim)
+    def observation_all(self, world):
+        geometry = world.geometry
+        n = geometry.n_agents
+        rows = np.arange(n)
+        # every other agent, in order
+        others = np.array([[j for j in range(n) if j != i] for i in range(n)], dtype=int).reshape(n, n - 1)
+        batch = geometry.p_pos.shape[:-2]
+        entity_pos = geometry.delta[..., :n, n:, :].reshape(batch + (n, -1))
+        other_pos = geometry.delta[..., rows[:, None], others, :].reshape(batch + (n, -1))
+        comm = world.agent_comm()[..., others, :].reshape(batch + (n, -1))
+        return np.concatenate([geometry.p_vel[..., :n, :], geometry.p_pos[..., :n, :], entity_pos, other_pos, comm],
+                              axis=-1)
@@ -4,20 +4,35 @@ from multiagent.scenario import BaseScenario
 
 
 class Scenario(BaseScenario):
+    # num_agents counts predators and prey. arena is the half width of the area the agents
+    # are kept in, None grows it with the number of agents (same density as the default)
+    defaults = dict(num_agents=6, num_good_agents=2, num_landmarks=2, neighbors=1, observing_range=0.7,
+                    arena=1.0, array_mode=False)
+    presets = {
+        # 100-1000 agents: array-backed physics, grid broad phase and Verlet neighbour lists
+        'large': dict(num_agents=200, num_good_agents=50, num_landmarks=10, neighbors=4, arena=None,
+                      array_mode=True),
+    }
+
     def make_world(self):
         world = World()
         # set any world properties first
         world.dim_c = 2
-        num_good_agents = 2  #1
-        num_adversaries = 4  #3
-        num_agents = num_adversaries + num_good_agents
-        num_landmarks = 2
-        observing_range = 0.7
+        num_good_agents = self.params['num_good_agents']
+        num_agents = self.params['num_agents']
+        num_adversaries = num_agents - num_good_agents
+        num_landmarks = self.params['num_landmarks']
+        observing_range = self.params['observing_range']
         world.num_adversaries = num_adversaries
         world.observing_range = observing_range
-        world.neighbors_pred = 1
-        world.neighbors_prey = 1
+        world.neighbors_pred = self.params['neighbors']
+        world.neighbors_prey = self.params['neighbors']
         world.min_corridor = 0.06
+        world.arena = self.params['arena'] if self.params['arena'] is not None else np.sqrt(num_agents / 6.0)
+        if self.params['array_mode']:
+            world.array_mode = True
+            world.collision_broadphase = 'grid'
+            world.neighbor_skin = 0.3
         # add agents
         world.agents = [Agent() for i in range(num_agents)]
         for i, agent in enumerate(world.agents):
@@ -53,23 +68,20 @@ class Scenario(BaseScenario):
             landmark.color = np.array([0.25, 0.25, 0.25])
         # set random initial states
         for agent in world.agents:
-            agent.state.p_pos = np.random.uniform(-1, +1, world.dim_p)
+            agent.state.p_pos = np.random.uniform(-world.arena, +world.arena, world.dim_p)
             agent.state.p_vel = np.zeros(world.dim_p)
             agent.state.c = np.zeros(world.dim_c)
         for i, landmark in enumerate(world.landmarks):
             if not landmark.boundary:
-                landmark.state.p_pos = np.random.uniform(-0.9, +0.9, world.dim_p)
+                landmark.state.p_pos = np.random.uniform(-0.9, +0.9, world.dim_p) * world.arena
                 landmark.state.p_vel = np.zeros(world.dim_p)
 
 
     def benchmark_data(self, agent, world):
         # returns data for benchmarking purposes
         if agent.adversary:
-            collisions = 0
-            for a in self.good_agents(world):
-                if self.is_collision(a, agent):
-                    collisions += 1
-            return collisions
+            catches, rank = self.catches(world)
+            return np.sum(catches[:, rank[world.geometry.index(agent)]])
         else:
             return 0
 
@@ -80,6 +92,21 @@ class Scenario(BaseScenario):
         dist_min = agent1.size + agent2.size
         return True if dist < dist_min else False
 
+    # prey x predator collision matrix (..., n_good, n_adversaries) of the current state and
+    # the row (good agents) or column (adversaries) of every agent in it, computed once per
+    # step and shared by all rewards and benchmark data
+    def catches(self, world):
+        geometry = world.geometry
+        if 'catches' not in geometry.cache:
+            adversary = np.array([agent.adversary for agent in world.agents], dtype=bool)
+            good_idx, adversary_idx = np.flatnonzero(~adversary), np.flatnonzero(adversary)
+            rank = np.zeros(len(adversary), dtype=int)
+            rank[good_idx] = np.arange(len(good_idx))
+            rank[adversary_idx] = np.arange(len(adversary_idx))
+            catches = geometry.overlap[..., good_idx[:, None], adversary_idx]
+            geometry.cache['catches'] = (catches, rank)
+        return geometry.cache['catches']
+
     # return all agents that are not adversaries
     def good_agents(self, world):
         return [agent for agent in world.agents if not agent.adversary]
@@ -103,9 +130,8 @@ class Scenario(BaseScenario):
             for adv in adversaries:
                 rew += 0.1 * np.sqrt(np.sum(np.square(agent.state.p_pos - adv.state.p_pos)))
         if agent.collide:
-            for a in adversaries:
-                if self.is_collision(a, agent):
-                    rew -= 10
+            catches, rank = self.catches(world)
+            rew -= 10 * np.sum(catches[rank[world.geometry.index(agent)]])
 
         # agents are penalized for exiting the screen, so that they can be caught by the adversaries
         def bound(x):
@@ -115,7 +141,7 @@ class Scenario(BaseScenario):
                 return (x - 0.9) * 10
             return min(np.exp(2 * x - 2), 10)
         for p in range(world.dim_p):
-            x = abs(agent.state.p_pos[p])
+            x = abs(agent.state.p_pos[p]) / world.arena
             rew -= bound(x)
 
         return rew
@@ -130,10 +156,8 @@ class Scenario(BaseScenario):
             for adv in adversaries:
                 rew -= 0.1 * min([np.sqrt(np.sum(np.square(a.state.p_pos - adv.state.p_pos))) for a in agents])
         if agent.collide:
-            for ag in agents:
-                for adv in adversaries:
-                    if self.is_collision(ag, adv):
-                        rew += 10
+            catches, _ = self.catches(world)
+            rew += 10 * np.sum(catches)
         return rew
 
     def observation(self, agent, world):
@@ -176,3 +200,45 @@ class Scenario(BaseScenario):
             if not other.adversary:
                 other_vel.append(other.state.p_vel)
         return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + other_vel)
+
+    # batched reward for all agents: (..., n_agents)
+    def reward_all(self, world):
+        geometry = world.geometry
+        n = geometry.n_agents
+        adversary = np.array([agent.adversary for agent in world.agents])
+        collide = np.array([agent.collide for agent in world.agents])
+        catches, _ = self.catches(world)
+        # times every good agent was caught
+        caught = np.zeros(catches.shape[:-2] + (n,))
+        caught[..., ~adversary] = np.sum(catches, axis=-1)
+        agent_rew = -10.0 * caught * collide
+        # agents are penalized for exiting the screen, so that they can be caught by the adversaries
+        x = np.abs(geometry.p_pos[..., :n, :]) / world.arena
+        bound = np.where(x < 0.9, 0.0, np.where(x < 1.0, (x - 0.9) * 10, np.minimum(np.exp(2 * x - 2), 10)))
+        agent_rew -= np.sum(bound, axis=-1)
+        adversary_rew = 10.0 * np.sum(catches, axis=(-2, -1))[..., None] * collide
+        return np.where(adversary, adversary_rew, agent_rew)
+
+    # batched observation for all agents, one (..., obs_dim) array per agent (good agents
+    # observe one velocity less than adversaries)
+    def observation_all(self, world):
+        geometry = world.geometry
+        n = geometry.n_agents
+        landmarks = n + np.array([i for i, entity in enumerate(world.landmarks) if not entity.boundary], dtype=int)
+        good = [j for j, agent in enumerate(world.agents) if not agent.adversary]
+        batch = geometry.p_pos.shape[:-2]
+        obs = [None] * n
+        for adversary in [True, False]:
+            rows = np.array([i for i, agent in enumerate(world.agents) if agent.adversary == adversary], dtype=int)
+            if len(rows) == 0:
+                continue
+            others = np.array([[j for j in range(n) if j != i] for i in rows], dtype=int).reshape(len(rows), n - 1)
+            good_others = np.array([[j for j in good if j != i] for i in rows], dtype=int).reshape(len(rows), -1)
+            entity_pos = geometry.delta[..., rows[:, None], landmarks, :].reshape(batch + (len(rows), -1))
+            other_pos = geometry.delta[..., rows[:, None], others, :].reshape(batch + (len(rows), -1))
+            other_vel = geometry.p_vel[..., good_others, :].reshape(batch + (len(rows), -1))
+            species_obs = np.concatenate([geometry.p_vel[..., rows, :], geometry.p_pos[..., rows, :], entity_pos,
+                                          other_pos, other_vel], axis=-1)
+            for r, i in enumerate(rows):
+                obs[i] = species_obs[..., r, :]
+        return obs
@@ -4,20 +4,35 @@ from multiagent.scenario import BaseScenario
 
 
 class Scenario(BaseScenario):
+    # num_agents counts predators and prey. arena is the half width of the area the agents
+    # are kept in, None grows it with the number of agents (same density as the default)
+    defaults = dict(num_agents=6, num_good_agents=2, num_landmarks=1, num_food=2, num_forests=2, neighbors=2,
+                    arena=1.0, array_mode=False)
+    presets = {
+        # 100-1000 agents: array-backed physics, grid broad phase and Verlet neighbour lists
+        'large': dict(num_agents=200, num_good_agents=50, num_landmarks=10, num_food=20, num_forests=10,
+                      neighbors=4, arena=None, array_mode=True),
+    }
+
     def make_world(self):
         world = World()
         # set any world properties first
         world.dim_c = 4
         #world.damping = 1
-        num_good_agents = 2
-        num_adversaries = 4
-        num_agents = num_adversaries + num_good_agents
-        num_landmarks = 1
-        num_food = 2
-        num_forests = 2
-        world.neighbors_pred = 2  # number of neighbors per pred
-        world.neighbors_prey = 2  # number of neighbors per prey
+        num_good_agents = self.params['num_good_agents']
+        num_agents = self.params['num_agents']
+        num_adversaries = num_agents - num_good_agents
+        num_landmarks = self.params['num_landmarks']
+        num_food = self.params['num_food']
+        num_forests = self.params['num_forests']
+        world.neighbors_pred = self.params['neighbors']  # number of neighbors per pred
+        world.neighbors_prey = self.params['neighbors']  # number of neighbors per prey
         world.num_adversaries = num_adversaries
+        world.arena = self.params['arena'] if self.params['arena'] is not None else np.sqrt(num_agents / 6.0)
+        if self.params['array_mode']:
+            world.array_mode = True
+            world.collision_broadphase = 'grid'
+            world.neighbor_skin = 0.3
         # add agents
         world.agents = [Agent() for i in range(num_agents)]
         for i, agent in enumerate(world.agents):
@@ -105,26 +120,23 @@ class Scenario(BaseScenario):
             landmark.color = np.array([0.6, 0.9, 0.6])
         # set random initial states
         for agent in world.agents:
-            agent.state.p_pos = np.random.uniform(-1, +1, world.dim_p)
+            agent.state.p_pos = np.random.uniform(-world.arena, +world.arena, world.dim_p)
             agent.state.p_vel = np.zeros(world.dim_p)
             agent.state.c = np.zeros(world.dim_c)
         for i, landmark in enumerate(world.landmarks):
-            landmark.state.p_pos = np.random.uniform(-0.9, +0.9, world.dim_p)
+            landmark.state.p_pos = np.random.uniform(-0.9, +0.9, world.dim_p) * world.arena
             landmark.state.p_vel = np.zeros(world.dim_p)
         for i, landmark in enumerate(world.food):
-            landmark.state.p_pos = np.random.uniform(-0.9, +0.9, world.dim_p)
+            landmark.state.p_pos = np.random.uniform(-0.9, +0.9, world.dim_p) * world.arena
             landmark.state.p_vel = np.zeros(world.dim_p)
         for i, landmark in enumerate(world.forests):
-            landmark.state.p_pos = np.random.uniform(-0.9, +0.9, world.dim_p)
+            landmark.state.p_pos = np.random.uniform(-0.9, +0.9, world.dim_p) * world.arena
             landmark.state.p_vel = np.zeros(world.dim_p)
 
     def benchmark_data(self, agent, world):
         if agent.adversary:
-            collisions = 0
-            for a in self.good_agents(world):
-                if self.is_collision(a, agent):
-                    collisions += 1
-            return collisions
+            catches, rank = self.catches(world)
+            return np.sum(catches[:, rank[world.geometry.index(agent)]])
         else:
             return 0
 
@@ -136,6 +148,30 @@ class Scenario(BaseScenario):
         return True if dist < dist_min else False
 
 
+    # prey x predator collision matrix (..., n_good, n_adversaries) of the current state and
+    # the row (good agents) or column (adversaries) of every agent in it, computed once per
+    # step and shared by all rewards and benchmark data
+    def catches(self, world):
+        geometry = world.geometry
+        if 'catches' not in geometry.cache:
+            adversary = np.array([agent.adversary for agent in world.agents], dtype=bool)
+            good_idx, adversary_idx = np.flatnonzero(~adversary), np.flatnonzero(adversary)
+            rank = np.zeros(len(adversary), dtype=int)
+            rank[good_idx] = np.arange(len(good_idx))
+            rank[adversary_idx] = np.arange(len(adversary_idx))
+            catches = geometry.overlap[..., good_idx[:, None], adversary_idx]
+            geometry.cache['catches'] = (catches, rank)
+        return geometry.cache['catches']
+
+    # agent x food collision matrix (..., n_agents, n_food) and distances of the current state
+    def food_contact(self, world):
+        geometry = world.geometry
+        if 'food' not in geometry.cache:
+            food_idx = np.array([geometry.index(food) for food in world.food], dtype=int)
+            n = geometry.n_agents
+            geometry.cache['food'] = (geometry.overlap[..., :n, food_idx], geometry.dist[..., :n, food_idx])
+        return geometry.cache['food']
+
     # return all agents that are not adversaries
     def good_agents(self, world):
         return [agent for agent in world.agents if not agent.adversary]
@@ -167,9 +203,8 @@ class Scenario(BaseScenario):
             for adv in adversaries:
                 rew += 0.1 * np.sqrt(np.sum(np.square(agent.state.p_pos - adv.state.p_pos)))
         if agent.collide:
-            for a in adversaries:
-                if self.is_collision(a, agent):
-                    rew -= 5
+            catches, rank = self.catches(world)
+            rew -= 5 * np.sum(catches[rank[world.geometry.index(agent)]])
         def bound(x):
             if x < 0.9:
                 return 0
@@ -177,14 +212,15 @@ class Scenario(BaseScenario):
                 return (x - 0.9) * 10
             return min(np.exp(2 * x - 2), 10)  # 1 + (x - 1) * (x - 1)
 
+        # the boundary is the edge of the arena
         for p in range(world.dim_p):
-            x = abs(agent.state.p_pos[p])
+            x = abs(agent.state.p_pos[p]) / world.arena
             rew -= 2 * bound(x)
 
-        for food in world.food:
-            if self.is_collision(agent, food):
-                rew += 2
-        rew += 0.05 * min([np.sqrt(np.sum(np.square(food.state.p_pos - agent.state.p_pos))) for food in world.food])
+        eats, food_dist = self.food_contact(world)
+        i = world.geometry.index(agent)
+        rew += 2 * np.sum(eats[i])
+        rew += 0.05 * np.min(food_dist[i])
 
         return rew
 
@@ -195,12 +231,11 @@ class Scenario(BaseScenario):
         agents = self.good_agents(world)
         adversaries = self.adversaries(world)
         if shape:
-            rew -= 0.1 * min([np.sqrt(np.sum(np.square(a.state.p_pos - agent.state.p_pos))) for a in agents])
+            geometry = world.geometry
+            rew -= 0.1 * np.min(geometry.dist[geometry.index(agent), [geometry.index(a) for a in agents]])
         if agent.collide:
-            for ag in agents:
-                for adv in adversaries:
-                    if self.is_collision(ag, adv):
-                        rew += 5
+            catches, _ = self.catches(world)
+            rew += 5 * np.sum(catches)
         return rew
 
 
@@ -228,68 +263,56 @@ class Scenario(BaseScenario):
         return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + other_vel)
 
     def observation(self, agent, world):
-        # get positions of all entities in this agent's reference frame
-        entity_pos = []
-        for entity in world.landmarks:
-            if not entity.boundary:
-                entity_pos.append(entity.state.p_pos - agent.state.p_pos)
-
-        in_forest = [np.array([-1]), np.array([-1])]
-        inf1 = False
-        inf2 = False
-        if self.is_collision(agent, world.forests[0]):
-            in_forest[0] = np.array([1])
-            inf1= True
-        if self.is_collision(agent, world.forests[1]):
-            in_forest[1] = np.array([1])
-            inf2 = True
-
-        food_pos = []
-        for entity in world.food:
-            if not entity.boundary:
-                food_pos.append(entity.state.p_pos - agent.state.p_pos)
-        # communication of all other agents
-        comm = []
-        other_pos = []
-        other_vel = []
-        for other in world.agents:
-            if other is agent: continue
-            comm.append(other.state.c)
-            oth_f1 = self.is_collision(other, world.forests[0])
-            oth_f2 = self.is_collision(other, world.forests[1])
-            if (inf1 and oth_f1) or (inf2 and oth_f2) or (not inf1 and not oth_f1 and not inf2 and not oth_f2) or agent.leader:  #without forest vis
-                other_pos.append(other.state.p_pos - agent.state.p_pos)
-                if not other.adversary:
-                    other_vel.append(other.state.p_vel)
-            else:
-                other_pos.append([0, 0])
-                if not other.adversary:
-                    other_vel.append([0, 0])
-
-        # to tell the pred when the prey are in the forest
-        prey_forest = []
-        ga = self.good_agents(world)
-        for a in ga:
-            if any([self.is_collision(a, f) for f in world.forests]):
-                prey_forest.append(np.array([1]))
+        return self.observation_all(world)[world.geometry.index(agent)]
+
+    # forest membership (..., n_agents, n_forests) of the current state
+    def forest_membership(self, world):
+        geometry = world.geometry
+        if 'forests' not in geometry.cache:
+            forest_idx = np.array([geometry.index(forest) for forest in world.forests], dtype=int)
+            geometry.cache['forests'] = geometry.overlap[..., :geometry.n_agents, forest_idx]
+        return geometry.cache['forests']
+
+    # observations of all agents, one (..., obs_dim) array per agent, built once per step.
+    # Agents see the others that share a forest with them or, outside all forests, the
+    # others outside too (the leader sees everyone); hidden positions and velocities are 0
+    def observation_all(self, world):
+        geometry = world.geometry
+        if 'observations' in geometry.cache:
+            return geometry.cache['observations']
+        n = geometry.n_agents
+        batch = geometry.p_pos.shape[:-2]
+        membership = self.forest_membership(world)
+        outside = ~np.any(membership, axis=-1)
+        leader = np.array([agent.leader for agent in world.agents], dtype=bool)
+        visible = np.any(membership[..., :, None, :] & membership[..., None, :, :], axis=-1)
+        visible |= outside[..., :, None] & outside[..., None, :]
+        visible |= leader[:, None]
+        in_forest = np.where(membership, 1.0, -1.0)
+        landmarks = n + np.array([i for i, entity in enumerate(world.landmarks) if not entity.boundary], dtype=int)
+        good = [j for j, agent in enumerate(world.agents) if not agent.adversary]
+        # everyone hears the first agent (the leader, when there is one)
+        comm = world.agent_comm()[..., 0, :]
+        obs = [None] * n
+        for adversary in [True, False]:
+            rows = np.array([i for i, agent in enumerate(world.agents) if agent.adversary == adversary], dtype=int)
+            if len(rows) == 0:
+                continue
+            others = np.array([[j for j in range(n) if j != i] for i in rows], dtype=int).reshape(len(rows), n - 1)
+            good_others = np.array([[j for j in good if j != i] for i in rows], dtype=int).reshape(len(rows), -1)
+            entity_pos = geometry.delta[..., rows[:, None], landmarks, :].reshape(batch + (len(rows), -1))
+            other_pos = np.where(visible[..., rows[:, None], others, None],
+                                 geometry.delta[..., rows[:, None], others, :], 0.0).reshape(batch + (len(rows), -1))
+            other_vel = np.where(visible[..., rows[:, None], good_others, None],
+                                 geometry.p_vel[..., good_others, :], 0.0).reshape(batch + (len(rows), -1))
+            parts = [geometry.p_vel[..., rows, :], geometry.p_pos[..., rows, :], entity_pos, other_pos]
+            if adversary:
+                species_comm = np.broadcast_to(comm[..., None, :], batch + (len(rows), comm.shape[-1]))
+                parts += [other_vel, in_forest[..., rows, :], species_comm]
             else:
-                prey_forest.append(np.array([-1]))
-        # to tell leader when pred are in forest
-        prey_forest_lead = []
-        for f in world.forests:
-            if any([self.is_collision(a, f) for a in ga]):
-                prey_forest_lead.append(np.array([1]))
-            else:
-                prey_forest_lead.append(np.array([-1]))
-
-        comm = [world.agents[0].state.c]
-
-        if agent.adversary and not agent.leader:
-            return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + other_vel + in_forest + comm)
-        if agent.leader:
-            return np.concatenate(
-                [agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + other_vel + in_forest + comm)
-        else:
-            return np.concatenate([agent.state.p_vel] + [agent.state.p_pos] + entity_pos + other_pos + in_forest + other_vel)
-
-
+                parts += [in_forest[..., rows, :], other_vel]
+            species_obs = np.concatenate(parts, axis=-1)
+            for r, i in enumerate(rows):
+                obs[i] = species_obs[..., r, :]
+        geometry.cache['observations'] = obs
+        return obs
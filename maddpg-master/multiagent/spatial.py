@@ -0,0 +1,183 @@
+import itertools
+import numpy as np
+
+
+# uniform grid (spatial hash) broad phase: all index pairs (a < b) of points that
+# fall in the same or in neighbouring cells, sorted by (a, b). Points with a
+# different group id (e.g. belonging to different worlds) are never paired.
+def grid_pairs(points, cell_size, group=None):
+    n, dim = points.shape
+    if n < 2:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    cells = np.floor(points / cell_size).astype(np.int64)
+    # shift so that every neighbouring cell coordinate stays non-negative
+    cells -= cells.min(axis=0) - 1
+    extent = cells.max(axis=0) + 2
+    strides = np.concatenate([[1], np.cumprod(extent[:-1])])
+    keys = cells.dot(strides)
+    if group is not None:
+        keys = keys + np.asarray(group, dtype=np.int64) * np.prod(extent)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    pair_a, pair_b = [], []
+    for offset in itertools.product((-1, 0, 1), repeat=dim):
+        neighbor_keys = keys + np.dot(offset, strides)
+        start = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+        counts = np.searchsorted(sorted_keys, neighbor_keys, side='right') - start
+        total = np.sum(counts)
+        if total == 0:
+            continue
+        a = np.repeat(np.arange(n), counts)
+        # position of every candidate in the sorted order
+        first = np.repeat(start - (np.cumsum(counts) - counts), counts)
+        b = order[first + np.arange(total)]
+        keep = a < b
+        pair_a.append(a[keep])
+        pair_b.append(b[keep])
+    if len(pair_a) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    pair_a = np.concatenate(pair_a)
+    pair_b = np.concatenate(pair_b)
+    order = np.lexsort((pair_b, pair_a))
+    return pair_a[order], pair_b[order]
+
+
+# indices (..., k) of the k smallest values along the last axis, smallest first and
+# ties in index order (the first k of a stable argsort), found by partitioning. Entries
+# that are inf (e.g. masked out) come last in no particular order
+def smallest_k(values, k):
+    n = values.shape[-1]
+    if k >= n:
+        return np.argsort(values, axis=-1, kind='stable')
+    # top-k by partition, then order the k selected by (value, index)
+    part = np.argpartition(values, k - 1, axis=-1)[..., :k]
+    part_values = np.take_along_axis(values, part, axis=-1)
+    smallest = np.take_along_axis(part, np.lexsort((part, part_values), axis=-1), axis=-1)
+    # rows where values tie with the k-th one must keep the lowest indices
+    kth = np.max(part_values, axis=-1, keepdims=True)
+    ties = (np.sum(values <= kth, axis=-1) > k) & np.isfinite(kth[..., 0])
+    if np.any(ties):
+        smallest[ties] = np.argsort(values[ties], axis=-1, kind='stable')[:, :k]
+    return smallest
+
+
+# indices (..., n, k) of the k nearest points of every point in points (..., n, dim),
+# nearest first (a point is its own nearest neighbour) and ties in index order,
+# -1 where the neighbour is not strictly within radius (or k exceeds n). dist2 can
+# pass in the squared distance matrix when it is already known.
+def knn_indices(points, k, radius, dist2=None):
+    if dist2 is None:
+        delta = points[..., None, :, :] - points[..., :, None, :]
+        dist2 = np.sum(np.square(delta), axis=-1)
+    n = dist2.shape[-1]
+    if k >= n:
+        nearest = np.argsort(dist2, axis=-1, kind='stable')
+        if k > n:
+            dist2 = np.concatenate([dist2, np.full(dist2.shape[:-1] + (1,), np.inf)], axis=-1)
+            padding = np.full(nearest.shape[:-1] + (k - n,), n)
+            nearest = np.concatenate([nearest, padding], axis=-1)
+    else:
+        nearest = smallest_k(dist2, k)
+    inside = np.take_along_axis(dist2, nearest, axis=-1) < radius * radius
+    return np.where(inside, nearest, -1)
+
+
+# one-hot encoding (..., n, k, num_classes) of neighbour indices, all-zero rows for -1
+def one_hot_neighbors(neighbors, num_classes, columns=None, out=None):
+    if out is None:
+        out = np.zeros(neighbors.shape + (num_classes,))
+    else:
+        out[...] = 0.0
+    valid = neighbors >= 0
+    index = neighbors[valid] if columns is None else columns[neighbors[valid]]
+    out[valid, index] = 1.0
+    return out
+
+
+# Verlet-style neighbour index: every point keeps a candidate list of the points
+# within radius + skin (itself included, in index order). The lists are rebuilt only
+# once some point has moved more than skin / 2 since the last build; until then
+# every pair closer than radius is guaranteed to be among the candidates.
+class NeighborIndex(object):
+    def __init__(self, radius, skin):
+        self.radius = radius
+        self.skin = skin
+        # (n, max candidates) point indices, padded with n
+        self.candidates = None
+        self.build_points = None
+        self.rebuilds = 0
+
+    def update(self, points):
+        if self.build_points is None or self.build_points.shape != points.shape:
+            self.build(points)
+            return
+        moved = np.sum(np.square(points - self.build_points), axis=-1)
+        if np.max(moved) > (self.skin / 2) ** 2:
+            self.build(points)
+
+    def build(self, points):
+        n = len(points)
+        cutoff = self.radius + self.skin
+        pair_a, pair_b = grid_pairs(points, cutoff)
+        close = np.sum(np.square(points[pair_a] - points[pair_b]), axis=-1) <= cutoff * cutoff
+        pair_a, pair_b = pair_a[close], pair_b[close]
+        src = np.concatenate([pair_a, pair_b, np.arange(n)])
+        dst = np.concatenate([pair_b, pair_a, np.arange(n)])
+        order = np.lexsort((dst, src))
+        src, dst = src[order], dst[order]
+        counts = np.bincount(src, minlength=n)
+        rank = np.arange(len(src)) - np.repeat(np.cumsum(counts) - counts, counts)
+        self.candidates = np.full((n, np.max(counts)), n)
+        self.candidates[src, rank] = dst
+        self.build_points = points.copy()
+        self.rebuilds += 1
+
+    # same result as knn_indices(points, k, radius), searching the candidates only
+    def knn(self, points, k):
+        self.update(points)
+        n = len(points)
+        padded = np.concatenate([points, np.full((1, points.shape[-1]), np.inf)])
+        dist2 = np.sum(np.square(padded[self.candidates] - points[:, None, :]), axis=-1)
+        dist2[self.candidates == n] = np.inf
+        order = np.argsort(dist2, axis=-1, kind='stable')[:, :k]
+        nearest = np.take_along_axis(self.candidates, order, axis=-1)
+        inside = np.take_along_axis(dist2, order, axis=-1) < self.radius * self.radius
+        nearest = np.where(inside, nearest, -1)
+        if nearest.shape[-1] < k:
+            nearest = np.concatenate([nearest, np.full((n, k - nearest.shape[-1]), -1)], axis=-1)
+        return nearest
+
+
+# centres (..., n, dim) of n discs with the given radii, uniform in [low, high) and more
+# than margin apart rim to rim, placed one after the other in every world of the leading
+# shape at once. Each disc takes the first of a batch of uniform proposals that clears the
+# discs placed before it, which is the distribution of plain rejection sampling. In the
+# last of max_rounds batches a world without a valid proposal takes the one with the most
+# clearance, so the cost is bounded even when the discs do not fit.
+def place_discs(radius, margin, low, high, dim, shape=(), candidates=16, max_rounds=8):
+    radius = np.asarray(radius, dtype=float)
+    n = len(radius)
+    n_worlds = int(np.prod(shape))
+    points = np.zeros((n_worlds, n, dim))
+    if n > 0:
+        points[:, 0] = np.random.uniform(low, high, (n_worlds, dim))
+    for i in range(1, n):
+        pending = np.arange(n_worlds)
+        min_dist = radius[:i] + radius[i] + margin
+        for attempt in range(max_rounds):
+            proposals = np.random.uniform(low, high, (len(pending), candidates, dim))
+            dist = np.sqrt(np.sum(np.square(proposals[:, :, None, :] - points[pending, None, :i, :]), axis=-1))
+            clearance = np.min(dist - min_dist, axis=-1)
+            valid = clearance > 0
+            found = np.any(valid, axis=-1)
+            pick = np.argmax(valid, axis=-1)
+            if attempt == max_rounds - 1:
+                pick = np.where(found, pick, np.argmax(clearance, axis=-1))
+                found[:] = True
+            points[pending[found], i] = proposals[found, pick[found]]
+            pending = pending[~found]
+            if len(pending) == 0:
+                break
+    return points.reshape(tuple(shape) + (n, dim))
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from multiagent.core import World, Agent, Landmark
+
+
+# random world of n entities with mixed collide/movable/max_speed, packed densely
+# enough that many pairs are in contact
+def make_world(n, seed):
+    rng = np.random.RandomState(seed)
+    world = World()
+    n_agents = rng.randint(1, n + 1)
+    world.agents = [Agent() for _ in range(n_agents)]
+    world.landmarks = [Landmark() for _ in range(n - n_agents)]
+    arena = 0.1 * np.sqrt(n)
+    for entity in world.entities:
+        entity.size = rng.uniform(0.02, 0.1)
+        entity.collide = rng.rand() < 0.8
+        entity.movable = rng.rand() < 0.7
+        entity.max_speed = rng.uniform(0.1, 2.0) if rng.rand() < 0.5 else None
+        entity.initial_mass = rng.uniform(0.5, 2.0)
+        entity.state.p_pos = rng.uniform(-arena, arena, world.dim_p)
+        entity.state.p_vel = rng.randn(world.dim_p)
+    for agent in world.agents:
+        agent.action.u = rng.randn(world.dim_p)
+    return world
+
+
+# action forces as the list-based step gathers them
+def action_force(world):
+    return world.apply_action_force([None] * len(world.entities))
+
+
+# forces of the list-based path as an array, entities without a force count as 0
+def as_array(p_force):
+    return np.array([np.zeros(2) if f is None else f for f in p_force])
+
+
+# the brute force broad phase gives the pairwise forces bit for bit. The grid leaves out pairs
+# further apart than broadphase_cutoff contact margins, each of which exerts less than
+# contact_force * contact_margin * exp(-broadphase_cutoff); entities are otherwise summed in
+# the same order, so the results agree up to these dropped contributions
+def assert_forces_equal(actual, expected, world):
+    if world.collision_broadphase == 'brute':
+        np.testing.assert_array_equal(actual, expected)
+    else:
+        atol = len(world.entities) * world.contact_force * world.contact_margin * np.exp(-world.broadphase_cutoff)
+        np.testing.assert_allclose(actual, expected, rtol=0, atol=atol)
+
+
+# (n, seed) cases from 3 to 120 entities
+CASES = [(n, seed) for seed, n in enumerate([3, 4, 7, 12, 25, 40, 64, 90, 120])]
+
+
+@pytest.mark.parametrize('n,seed', CASES)
+@pytest.mark.parametrize('broadphase', ['brute', 'grid'])
+def test_apply_environment_force_matches_pairwise(n, seed, broadphase):
+    world = make_world(n, seed)
+    world.collision_broadphase = broadphase
+    expected = world.apply_environment_force_pairwise(action_force(world))
+    p_force = world.apply_environment_force(action_force(world))
+    if broadphase == 'brute':
+        assert [f is None for f in p_force] == [f is None for f in expected]
+    assert_forces_equal(as_array(p_force), as_array(expected), world)
+
+
+@pytest.mark.parametrize('n,seed', CASES)
+@pytest.mark.parametrize('broadphase', ['brute', 'grid'])
+def test_apply_environment_force_arrays_matches_pairwise(n, seed, broadphase):
+    world = make_world(n, seed)
+    world.collision_broadphase = broadphase
+    expected = as_array(world.apply_environment_force_pairwise(action_force(world)))
+    world.array_mode = True
+    world.build_arrays()
+    p_force = world.apply_environment_force_arrays(world.apply_action_force_arrays())
+    assert_forces_equal(p_force, expected, world)
+
+
+# a full step of the array-based physics (max_speed included) against the list-based step
+# with the pairwise forces
+@pytest.mark.parametrize('n,seed', CASES)
+def test_step_arrays_matches_pairwise(n, seed):
+    world = make_world(n, seed)
+    reference = make_world(n, seed)
+    reference.integrate_state(reference.apply_environment_force_pairwise(action_force(reference)))
+    for agent in world.agents:
+        agent.silent = True
+    world.array_mode = True
+    world.step()
+    for entity, expected in zip(world.entities, reference.entities):
+        np.testing.assert_array_equal(entity.state.p_vel, expected.state.p_vel)
+        np.testing.assert_array_equal(entity.state.p_pos, expected.state.p_pos)
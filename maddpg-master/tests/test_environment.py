@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+import multiagent.scenarios as scenarios
+from multiagent.environment import MultiAgentEnv
+
+
+# simple_tag with immovable and talking agents mixed in, so that the flat actions of the
+# agents have different layouts
+def make_env(discrete_action=True):
+    scenario = scenarios.make('simple_tag')
+    world = scenario.make_world()
+    world.discrete_action = discrete_action
+    for i, agent in enumerate(world.agents):
+        agent.movable = i % 3 != 1
+        agent.silent = agent.movable and i % 2 == 0
+    return MultiAgentEnv(world, scenario.reset_world, scenario.reward, scenario.observation)
+
+
+# flat random actions that fit the action space of every agent
+def random_actions(env, rng):
+    sizes = [space.n if hasattr(space, 'n') else int(np.sum(space.high - space.low + 1))
+             for space in env.action_space]
+    return [rng.rand(size) for size in sizes]
+
+
+# physical and communication actions of the per-agent _set_action, and the actions it
+# leaves behind (the forced one-hot is written back)
+def reference_actions(env, action_n):
+    action_n = [action.copy() for action in action_n]
+    u, c = [], []
+    for i, agent in enumerate(env.agents):
+        env._set_action(action_n[i], agent, env.action_space[i])
+        u.append(agent.action.u.copy())
+        c.append(agent.action.c.copy())
+    return u, c, action_n
+
+
+# step decodes a forced discrete action in one batch, with the same agent actions and the
+# same one-hot written back into the caller's list as the per-agent loop
+@pytest.mark.parametrize('discrete_action', [False, True])
+def test_step_decodes_actions_like_set_action(discrete_action):
+    env = make_env(discrete_action)
+    env.reset()
+    rng = np.random.RandomState(0)
+    for _ in range(3):
+        action_n = random_actions(env, rng)
+        u, c, expected = reference_actions(env, action_n)
+        env.step(action_n)
+        for i, agent in enumerate(env.agents):
+            np.testing.assert_allclose(agent.action.u, u[i], rtol=1e-12)
+            np.testing.assert_array_equal(agent.action.c, c[i])
+            np.testing.assert_array_equal(action_n[i], expected[i])
+
+
+# an (n, act_dim) array is decoded, and forced, in place
+def test_forced_actions_array_in_place():
+    env = make_env()
+    env.reset()
+    action_n = random_actions(env, np.random.RandomState(1))
+    u, c, expected = reference_actions(env, action_n)
+    actions = env._stack_actions(action_n)
+    env._set_actions(actions)
+    for i, agent in enumerate(env.agents):
+        np.testing.assert_allclose(agent.action.u, u[i], rtol=1e-12)
+        np.testing.assert_array_equal(actions[i, :len(expected[i])], expected[i])
+
+
+# the (n_worlds, n, ...) buffers of step_arrays hold what step() returns, zero padded and
+# in float32, through automatic resets of the copies
+@pytest.mark.parametrize('name', ['simple_spread', 'simple_tag'])
+def test_vector_step_arrays_matches_step(name):
+    env, array_env = [scenarios.make_vector_env(name, 3, max_episode_len=4) for _ in range(2)]
+
+    def assert_matches(obs, adj, obs_n, adj_n):
+        for i in range(env.n):
+            size = obs_n[i].shape[-1]
+            np.testing.assert_array_equal(obs[:, i, :size], obs_n[i].astype(np.float32))
+            assert not np.any(obs[:, i, size:])
+            k, m = adj_n[i].shape[1:]
+            np.testing.assert_array_equal(adj[:, i, :k, :m], adj_n[i])
+            assert np.sum(adj[:, i]) == np.sum(adj_n[i])
+
+    np.random.seed(0)
+    obs_n, adj_n = env.reset()
+    np.random.seed(0)
+    obs, adj = array_env.reset_arrays()
+    assert obs.dtype == adj.dtype == np.float32 and obs.shape[:2] == adj.shape[:2] == (3, env.n)
+    assert_matches(obs, adj, obs_n, adj_n)
+    rng = np.random.RandomState(1)
+    resets = 0
+    for t in range(10):
+        actions = rng.rand(3, env.n, env.action_space[0].n)
+        np.random.seed(t)
+        obs_n, rew_n, done_n, info_n, adj_n = env.step(list(actions.transpose(1, 0, 2)))
+        np.random.seed(t)
+        obs, rew, done, info, adj = array_env.step_arrays(actions)
+        np.testing.assert_array_equal(rew, rew_n.astype(np.float32))
+        np.testing.assert_array_equal(done, done_n)
+        np.testing.assert_array_equal(info['terminal'], info_n['terminal'])
+        assert_matches(obs, adj, obs_n, adj_n)
+        if np.any(info['terminal']):
+            assert t % 4 == 3
+            resets += 1
+            terminal = info['terminal']
+            assert_matches(info['terminal_obs'], info['terminal_adj'],
+                           [o[terminal] for o in info_n['terminal_obs_n']],
+                           [a[terminal] for a in info_n['terminal_adj_n']])
+    assert resets == 2
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import multiagent.scenarios as scenarios
+
+
+# every named preset of every scenario that has them
+PRESETS = [(name, preset) for name in scenarios.names()
+           for preset in sorted(scenarios.load(name).Scenario.presets)]
+
+
+def test_large_presets_exist():
+    assert set(name for name, preset in PRESETS if preset == 'large') >= \
+        {'simple_spread', 'simple_tag', 'simple_world_comm'}
+
+
+# build the environment of a preset and step it with random actions, in both the list
+# and the array API: observations match the observation spaces and the adjacency has
+# the neighbour counts of the world, which are what the trainer is built with
+@pytest.mark.parametrize('name,preset', PRESETS)
+def test_preset_steps(name, preset):
+    np.random.seed(0)
+    env = scenarios.make_env(name, preset)
+    world = env.world
+    num_adversaries = world.num_adversaries
+    obs_n, adj_n = env.reset()
+    for _ in range(3):
+        action_n = [np.random.dirichlet(np.ones(space.n)) for space in env.action_space]
+        obs_n, rew_n, done_n, info_n, adj_n = env.step(action_n)
+    assert len(obs_n) == len(adj_n) == len(rew_n) == env.n
+    for i in range(env.n):
+        assert obs_n[i].shape == env.observation_space[i].shape
+        assert np.all(np.isfinite(obs_n[i])) and np.isfinite(rew_n[i])
+        if i < num_adversaries:
+            assert adj_n[i].shape == (world.neighbors_pred, num_adversaries)
+        else:
+            assert adj_n[i].shape == (world.neighbors_prey, env.n - num_adversaries)
+    actions = np.random.dirichlet(np.ones(env.action_space[0].n), size=env.n)
+    obs, rew, done, info, adj = env.step_arrays(actions)
+    assert obs.shape[0] == rew.shape[0] == adj.shape[0] == env.n
+    assert adj.shape[1] == max(world.neighbors_pred, world.neighbors_prey)
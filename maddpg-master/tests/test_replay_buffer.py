@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+import multiagent.scenarios as scenarios
+from maddpg.trainer.replay_buffer import ArrayReplayBuffer, DTYPE_POLICIES, JointReplayBuffer, \
+    PrioritizedReplayBuffer, ReplayBuffer
+
+
+# a few transitions of two agents with 2 neighbours, written to every buffer
+def fill(buffers, steps=10):
+    for t in range(steps):
+        obs = [np.full(4, t, dtype=float), np.full(4, -t, dtype=float)]
+        act = [np.eye(5)[t % 5], np.eye(5)[(t + 1) % 5]]
+        adj = [np.eye(2), np.eye(2)[::-1]]
+        for buffer in buffers:
+            buffer.add(obs, act, [1.0, 2.0], obs, [0.0, 0.0], adj, adj)
+
+
+# the joint buffer forwards make_index arguments to its first buffer, a prioritized one
+# takes the same signature and rejects what it cannot honour
+def test_joint_make_index_with_prioritized_first_buffer():
+    prioritized = PrioritizedReplayBuffer(16, seed=0)
+    joint = JointReplayBuffer([prioritized, ArrayReplayBuffer(16, seed=0)])
+    fill(joint.buffers)
+    idxes = joint.make_index(8, replace=True, chunk=None)
+    assert idxes.shape == (8,) and np.all((idxes >= 0) & (idxes < len(prioritized)))
+    with pytest.raises(ValueError):
+        joint.make_index(8, replace=False)
+    with pytest.raises(ValueError):
+        joint.make_index(8, chunk=2)
+
+
+# float16 keeps 11 significant bits; values below its smallest normal number (2 ** -14)
+# are stored with an absolute error of at most 2 ** -25
+FLOAT16_RTOL = 2.0 ** -11
+FLOAT16_ATOL = 2.0 ** -25
+
+
+# transitions of the adversaries of a simple_tag rollout, added as train.py adds them to a
+# trainer's buffer
+def rollout(buffers, steps=64):
+    np.random.seed(0)
+    env = scenarios.make_env('simple_tag', 'large', num_agents=40, num_good_agents=10)
+    k = env.world.num_adversaries
+    obs_n, adj_n = env.reset()
+    for _ in range(steps):
+        action_n = [np.random.dirichlet(np.ones(space.n)) for space in env.action_space]
+        new_obs_n, rew_n, done_n, info_n, new_adj_n = env.step(action_n)
+        for buffer in buffers:
+            buffer.add(obs_n[:k], action_n[:k], rew_n[:k], new_obs_n[:k], [float(x) for x in done_n[:k]],
+                       adj_n[:k], new_adj_n[:k])
+        obs_n, adj_n = new_obs_n, new_adj_n
+
+
+# the batches that MADDPGAgentTrainer.update feeds to its float32 placeholders, from the
+# array-backed storage policies against the tuple layout: exact in float32, and within
+# the float16 rounding for the observations and actions stored as float16
+@pytest.mark.parametrize('dtype_policy', ['float32', 'float16'])
+@pytest.mark.parametrize('compact_adj', [False, True])
+def test_storage_policies_match_tuple_layout(dtype_policy, compact_adj):
+    reference = ReplayBuffer(100, seed=0)
+    buffer = ArrayReplayBuffer(100, seed=0, compact_adj=compact_adj, dtype_policy=dtype_policy)
+    rollout([reference, buffer])
+    index = reference.make_index(32)
+    stored = DTYPE_POLICIES[dtype_policy]
+    for name, value, expected in zip(ArrayReplayBuffer.fields, buffer.sample_index(index),
+                                     reference.sample_index(index)):
+        assert value.shape == expected.shape
+        value, expected = value.astype(np.float32), expected.astype(np.float32)
+        if stored.get(name) == np.float16:
+            np.testing.assert_allclose(value, expected, rtol=FLOAT16_RTOL, atol=FLOAT16_ATOL)
+        else:
+            np.testing.assert_array_equal(value, expected)
@@ -0,0 +1,70 @@
+import numpy as np
+
+import multiagent.scenarios as scenarios
+from multiagent.reference import reference_spread_reward, reference_spread_observation
+
+
+# (preset, size parameters) of the worlds compared: fewer than 3 landmarks or other agents,
+# short observing ranges that leave agents with fewer than 3 (or no) visible entities, and
+# larger swarms in the array-based preset
+WORLDS = [
+    (None, dict(num_agents=2, num_landmarks=1)),
+    (None, dict(num_agents=3, num_landmarks=2, observing_range=0.3)),
+    (None, dict(num_agents=5, num_landmarks=5)),
+    (None, dict(num_agents=12, num_landmarks=7, observing_range=0.2)),
+    (None, dict(num_agents=30, num_landmarks=30, observing_range=0.05)),
+    ('large', dict(num_agents=40, num_landmarks=40)),
+    ('large', dict(num_agents=100, num_landmarks=20, observing_range=0.3)),
+]
+
+
+# the scenario and a few reset worlds of each entry of WORLDS
+def make_worlds(resets=2):
+    np.random.seed(0)
+    for preset, params in WORLDS:
+        scenario = scenarios.make('simple_spread', preset, **params)
+        world = scenario.make_world()
+        for _ in range(resets):
+            scenario.reset_world(world)
+            yield scenario, world
+
+
+def test_worlds_cover_partial_visibility():
+    n_visible = []
+    for scenario, world in make_worlds():
+        geometry = world.geometry
+        visible = geometry.dist[:geometry.n_agents] < world.observing_range
+        n_visible.extend(np.sum(visible, axis=-1) - 1)
+    assert min(n_visible) == 0
+    assert np.mean(np.array(n_visible) < 3) > 0.1
+
+
+def test_reward_all_matches_reference():
+    for scenario, world in make_worlds():
+        expected = [reference_spread_reward(scenario, agent, world) for agent in world.agents]
+        np.testing.assert_allclose(scenario.reward_all(world), expected, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose([scenario.reward(agent, world) for agent in world.agents], expected,
+                                   rtol=1e-12, atol=1e-12)
+
+
+def test_observation_all_matches_reference():
+    for scenario, world in make_worlds():
+        expected = np.array([reference_spread_observation(agent, world) for agent in world.agents])
+        np.testing.assert_array_equal(scenario.observation_all(world), expected)
+        np.testing.assert_array_equal([scenario.observation(agent, world) for agent in world.agents], expected)
+
+
+# moving entities drops the geometry of the previous state, without invalidate_geometry()
+def test_geometry_follows_moved_entities():
+    np.random.seed(1)
+    for preset in [None, 'large']:
+        scenario = scenarios.make('simple_spread', preset, num_agents=6, num_landmarks=6)
+        world = scenario.make_world()
+        scenario.reward_all(world)
+        scenario.reset_world(world)
+        agent = world.agents[0]
+        assert scenario.reward(agent, world) == reference_spread_reward(scenario, agent, world)
+        agent.state.p_pos = world.landmarks[0].state.p_pos + 0.01
+        assert scenario.reward(agent, world) == reference_spread_reward(scenario, agent, world)
+        agent.state.p_pos += 0.5
+        np.testing.assert_array_equal(scenario.observation(agent, world), reference_spread_observation(agent, world))
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from multiagent.reference import reference_adjacency
+from multiagent.spatial import knn_indices, one_hot_neighbors, NeighborIndex
+
+
+# (n, k, radius) of the random worlds: every point in range, few in range, and k at
+# or beyond the number of points
+CASES = [(1, 1, 0.8), (2, 3, 0.8), (5, 2, 10.0), (8, 8, 0.8), (12, 4, 0.3), (12, 20, 0.5),
+         (40, 4, 0.8), (64, 6, 0.2), (150, 3, 0.4)]
+
+
+def one_hot_knn(points, k, radius, **kwargs):
+    return one_hot_neighbors(knn_indices(points, k, radius, **kwargs), len(points))
+
+
+@pytest.mark.parametrize('n,k,radius', CASES)
+def test_knn_adjacency_matches_argsort(n, k, radius):
+    rng = np.random.RandomState(n * 31 + k)
+    for _ in range(5):
+        points = rng.uniform(-1.0, 1.0, (n, 2))
+        np.testing.assert_array_equal(one_hot_knn(points, k, radius), reference_adjacency(points, k, radius))
+
+
+# points on a lattice (and duplicated points) have many exactly equal distances, which
+# must be resolved in index order as a stable argsort does, also by the partition of
+# smallest_k. Radius 0.5 falls exactly on lattice distances, which are not neighbours
+@pytest.mark.parametrize('k', [1, 2, 3, 5, 9, 30])
+def test_knn_adjacency_ties(k):
+    rng = np.random.RandomState(k)
+    lattice = 0.25 * np.stack(np.meshgrid(np.arange(5), np.arange(5)), axis=-1).reshape(-1, 2)
+    for radius in [0.3, 0.5, 0.6]:
+        for points in [lattice, lattice[rng.permutation(len(lattice))], np.concatenate([lattice, lattice[::3]])]:
+            np.testing.assert_array_equal(one_hot_knn(points, k, radius), reference_adjacency(points, k, radius))
+
+
+# a batch of worlds with leading dimensions, with the squared distances passed in, and
+# the adjacency columns of an agent species written into a given buffer
+def test_knn_adjacency_batched():
+    rng = np.random.RandomState(0)
+    points = rng.uniform(-1.0, 1.0, (3, 2, 20, 2))
+    dist2 = np.sum(np.square(points[..., None, :, :] - points[..., :, None, :]), axis=-1)
+    columns = rng.permutation(20)
+    out = np.full((3, 2, 20, 4, 20), np.nan)
+    adj = one_hot_neighbors(knn_indices(points, 4, 0.6, dist2=dist2), 20, columns, out)
+    assert adj is out
+    for index in np.ndindex(3, 2):
+        np.testing.assert_array_equal(out[index], reference_adjacency(points[index], 4, 0.6, columns=columns))
+
+
+# a trajectory of a swarm with small steps (kept by the candidate lists), jumps of more
+# than skin / 2 (which rebuild them) and resets to new positions and to a different
+# number of points: every query matches the argsort adjacency
+@pytest.mark.parametrize('n,k,radius,skin', [(30, 3, 0.4, 0.2), (80, 5, 0.3, 0.1), (10, 12, 0.8, 0.3)])
+def test_neighbor_index_trajectory(n, k, radius, skin):
+    rng = np.random.RandomState(n)
+    index = NeighborIndex(radius, skin)
+    points = rng.uniform(-1.0, 1.0, (n, 2))
+    rebuilds = []
+    for t in range(60):
+        if t % 20 == 19:
+            # reset, with one more point each time
+            points = rng.uniform(-1.0, 1.0, (n + t // 20 + 1, 2))
+        elif t % 7 == 6:
+            points = points.copy()
+            points[rng.randint(len(points))] += 0.6 * skin * np.array([1.0, -1.0])
+        else:
+            points = points + rng.uniform(-0.05, 0.05, points.shape) * skin
+        adj = one_hot_neighbors(index.knn(points, k), len(points))
+        np.testing.assert_array_equal(adj, reference_adjacency(points, k, radius))
+        rebuilds.append(index.rebuilds)
+    # the small steps reuse the lists, the jumps and resets force rebuilds
+    assert 1 + 3 + 8 <= rebuilds[-1] < 30
+    assert len(set(rebuilds[:6])) == 1
+
+
+# update keeps the lists while every point has moved at most skin / 2 since the last
+# build, and rebuilds from the current points as soon as one moves further
+def test_neighbor_index_rebuilds_on_skin():
+    index = NeighborIndex(0.5, 0.2)
+    points = np.random.RandomState(0).uniform(-1.0, 1.0, (20, 2))
+    index.update(points)
+    moved = points.copy()
+    moved[3] += [0.099, 0.0]
+    index.update(moved)
+    assert index.rebuilds == 1
+    moved[3] += [0.002, 0.0]
+    index.update(moved)
+    assert index.rebuilds == 2
+    np.testing.assert_array_equal(index.build_points, moved)